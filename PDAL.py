@@ -1,24 +1,39 @@
 # File to generate PDAL configuration for a sfm point cloud
 from jinja2 import Template, Environment, FileSystemLoader
 import numpy as np 
+
+# Compiled templates shared by all PDAL objects, keyed by (folder, file name)
+_templates = {}
+
+
+def load_template(template_file, template_dir='templates'):
+    """ Loads and compiles a template once per process """
+    key = (template_dir, template_file)
+    if key not in _templates:
+        env = Environment(loader=FileSystemLoader(template_dir),
+                          trim_blocks=True)
+        _templates[key] = env.get_template(template_file)
+    return _templates[key]
+
+
 class PDAL():
     """ Creates a PDAL object for use in PDAL configuration """
     def __init__(self,
         template_file="sfm_cloudprocess.template",
         output_file="sfm_cloudprocess.json",
-        points=None):
+        points=None,
+        template_dir='templates'):
         # Define the files
         self.pdal_template_file = template_file
         self.output_file = output_file
 
         # Load up the PDAL template file that we will use to make our PDAL json file. 
-        self.env = Environment(loader=FileSystemLoader('templates'),     # Look for templates in templates/ folder                                                                                                      
-                            trim_blocks=True)
-        self.template = self.env.get_template(self.pdal_template_file) # Jinja2 will find the template.
+        # The template is compiled on first use and shared by later PDAL objects.
+        self.template = load_template(self.pdal_template_file, template_dir)
+        self.env = self.template.environment
         # Points used to define the cropping polygon must be defined as an 
         # array of points, with x, y values:
-        if points:
-            self.points = points
+        self.points = points
     
     # Helper functions to generate properly formated strings that we will put into the PDAL file.
     @classmethod
@@ -190,7 +205,7 @@ class PDAL():
         else:
             P.extend([1, 1])
 
-        return list(np.matmul(M,P))[0:2]
+        return np.matmul(M,P)[0:2].tolist()
 
     @classmethod
     def translation_matrix(cls, points, dim=3):
@@ -239,6 +254,65 @@ class PDAL():
                 [0, 0, 0, 1]
             ]
 
+    @classmethod
+    def transformation_matrix(cls, points, dim=3):
+        """ Combines the rotation and translation matrices into a single
+        affine transformation (rotate, then translate).
+
+        >>> points = [
+        ...   [262986.2, 53128.25],   # lower right corner of crop area
+        ...   [262967.5, 53029.84],   # lower left corner of crop area
+        ...   [262870.1, 53048.72],   # upper left corner of crop area
+        ...   [262888.9, 53148.19],   # upper right corner of crop area
+        ... ]
+        >>> M = PDAL.transformation_matrix(points)
+        >>> PDAL.transform_points(np.array([PDAL.lower_left(points)]), M).round(6).tolist()  # NOQA
+        [[0.0, 0.0]]
+        """
+        return np.matmul(
+            cls.translation_matrix(points, dim),
+            cls.rotation_matrix(points, dim)).tolist()
+
+    @classmethod
+    def transform_points(cls, points, M, out=None, chunk_size=65536):
+        """ Transform an N x 2 or N x 3 array of points with an affine matrix
+
+        M is a 3 x 3 (2D) or 4 x 4 (3D) affine matrix, such as
+        transformation_matrix(); N x 2 points with a 4 x 4 matrix are taken
+        to lie at z = 0. Points are transformed in blocks of chunk_size
+        rows, so temporaries stay cache-sized. The result is written to
+        out, which may be points itself (e.g. a writable memmap) to
+        transform in place; a new array is returned if out is None.
+
+        >>> from math import cos, sin, pi
+        >>> theta = pi/2
+        >>> rotation_matrix = [
+        ... [cos(theta), sin(theta), 0, 0],
+        ... [-sin(theta), cos(theta), 0, 0],
+        ... [0, 0, 1, 0],
+        ... [0, 0, 0, 1]]
+        >>> points = np.array([[3., 2., 5.], [1., 0., 0.]])
+        >>> PDAL.transform_points(points, rotation_matrix).round(12).tolist()
+        [[2.0, -3.0, 5.0], [0.0, -1.0, 0.0]]
+        >>> _ = PDAL.transform_points(points[:, :2], rotation_matrix, out=points[:, :2])  # NOQA
+        >>> points.round(12).tolist()
+        [[2.0, -3.0, 5.0], [0.0, -1.0, 0.0]]
+        """
+        M = np.asarray(M, dtype=float)
+        d = points.shape[1]
+        if M.shape[0] == 4 and d == 2:
+            M = M[np.ix_([0, 1, 3], [0, 1, 3])]
+        A = M[:d, :d].T
+        b = M[:d, d]
+        if out is None:
+            out = np.empty(points.shape, dtype=np.result_type(points, float))
+        for start in range(0, len(points), chunk_size):
+            stop = start + chunk_size
+            block = np.matmul(points[start:stop], A)
+            block += b
+            out[start:stop] = block
+        return out
+
     def make_pdal_params(self):
         """
         Create a dictionary of PDAL parameters
@@ -272,29 +346,37 @@ class PDAL():
                 "scalar": 1.5
             },
             "crop": {
-                "polygon": self.make_polygon(points)
+                "polygon": self.make_polygon(self.points)
             },
             "matrix":{
                 "transformation": self.make_matrix(
-                    matrix=self.rotation_matrix(points)
+                    matrix=self.rotation_matrix(self.points)
                 ),
-                "translation": self.make_matrix(matrix=self.translation_matrix(points))
+                "translation": self.make_matrix(matrix=self.translation_matrix(self.points))
             }
         } 
         return pdal_params
 
-    def write_json(self, output_file=None):
+    def render(self, files=None):
+        """ Renders the PDAL configuration as a JSON string
+
+        files optionally names the 'input' cloud and 'output' cloud, which
+        are added as the first and last stages of the pipeline.
+        """
+        pdal_params = self.make_pdal_params()
+        return self.template.render(
+            pipeline=pdal_params['pipeline'],
+            crop=pdal_params['crop'],
+            matrix=pdal_params['matrix'],
+            files=files or {})
+
+    def write_json(self, output_file=None, files=None):
         """ Writes PDAL configuration as a JSON file """
         if output_file:
             filename = output_file
         else:
             filename = self.output_file
-        pdal_params = self.make_pdal_params()
-
-        rendered_template = self.template.render(
-            pipeline=pdal_params['pipeline'],
-            crop=pdal_params['crop'],
-            matrix=pdal_params['matrix'])
+        rendered_template = self.render(files)
 
         with open(filename, 'w') as f:
             print(rendered_template, file=f)
@@ -0,0 +1,188 @@
+########################################################################
+#
+# batch.py - process every plot of a plot table in one command
+#
+# for each row of uhu_pdal_pointcloud_params.csv, crop the source cloud
+# to the plot polygon, rotate and translate it into the plot frame with
+# the PDAL class geometry, bin it into subplots and write the products
+# to <output_dir>/<plotid>/; plots run across a process pool and plots
+# whose products are already complete are skipped
+#
+########################################################################
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from PDAL import PDAL
+from crop import PlotCrop
+from pointcloud_io import read_chunks
+from raster import chm_dtm, rasterize
+from subset_data import subplot_stats
+from tile_index import TileIndex, is_tile_index
+
+
+# written last, so its presence marks a plot's products as complete
+STATUS_FILE = 'status.json'
+
+
+def read_plot_table(filename='uhu_pdal_pointcloud_params.csv', plots=None):
+    """ Plot ids and corner points (P1-P4, as [x, y] lists) of a plot table.
+
+    plots optionally restricts the table to plot ids starting with any of
+    the given prefixes, e.g. ['uhnb3'] for the north 3 block.
+
+    >>> table = read_plot_table(plots=['uhnb3'])
+    >>> [plotid for plotid, corners in table]
+    ['uhnb3mes', 'uhnb3meg', 'uhnb3con', 'uhnb3tot']
+    >>> table[0][1]
+    [[262986.18, 53128.25], [262967.5, 53029.843], [262870.13, 53048.717], [262888.92, 53148.193]]
+    """
+    table = pd.read_csv(filename)
+    rows = []
+    for _, row in table.iterrows():
+        if plots and not any(row['plotid'].startswith(p) for p in plots):
+            continue
+        corners = [json.loads(row[p]) for p in ('P1', 'P2', 'P3', 'P4')]
+        rows.append((row['plotid'], corners))
+    return rows
+
+
+def plot_chunks(chunks, corners, crop=True):
+    """ Crop a stream of chunks to the plot polygon and move the kept
+    points into the plot frame (lower left corner at the origin, lower
+    edge along X), as the PDAL pipeline's crop and transformation
+    filters do. Set crop to False for chunks that are already cropped,
+    e.g. from TileIndex.crop """
+    if crop:
+        for chunk in PlotCrop(corners).crop_chunks(chunks, transform=True):
+            yield chunk
+        return
+    M = PDAL.transformation_matrix(corners)
+    for chunk in chunks:
+        xyz = np.column_stack((chunk['X'], chunk['Y'], chunk['Z']))
+        PDAL.transform_points(xyz, M, out=xyz)
+        chunk['X'] = xyz[:, 0]
+        chunk['Y'] = xyz[:, 1]
+        yield chunk
+
+
+def is_complete(plot_dir):
+    return os.path.exists(os.path.join(plot_dir, STATUS_FILE))
+
+
+def process_plot(plotid, corners, cloud, output_dir, dxy=1., dz=0.25,
+                 chunk_size=1000000, force=False, raster_res=0.2):
+    """ Crop, transform and bin one plot; returns its status dict.
+
+    cloud is a LAS, xyz/csv or cache path, read with
+    pointcloud_io.read_chunks, or a tile_index.build_index directory,
+    which is cropped without scanning the whole cloud; a '{plotid}' in it
+    is replaced by the plot id, otherwise the same block cloud is cropped
+    for every plot. Writes subplots.csv (points per Xbin, Ybin, Zbin
+    voxel), columns.csv (max height and points per Xbin, Ybin column) and,
+    unless raster_res is 0, max and min Z rasters on the plot grid
+    (plot_chm.npy, plot_dtm.npy and their .wld world files) to
+    output_dir/plotid.
+    """
+    plot_dir = os.path.join(output_dir, plotid)
+    if is_complete(plot_dir) and not force:
+        return {'plotid': plotid, 'status': 'skipped'}
+    start = time.perf_counter()
+    try:
+        source = cloud.format(plotid=plotid)
+        if is_tile_index(source):
+            chunks = plot_chunks(TileIndex(source).crop(corners), corners,
+                                 crop=False)
+        else:
+            chunks = plot_chunks(read_chunks(source, chunk_size), corners)
+        os.makedirs(plot_dir, exist_ok=True)
+        if raster_res:
+            crop = PlotCrop(corners)
+            chunks = rasterize(chunks, chm_dtm(
+                os.path.join(plot_dir, 'plot'), crop.lo, crop.hi,
+                raster_res), crop.M)
+        counts_by_subplot, max_height, n_points = subplot_stats(
+            chunks, dxy, dz)
+        counts_by_subplot.rename('count').to_csv(
+            os.path.join(plot_dir, 'subplots.csv'))
+        pd.DataFrame({'max_height': max_height, 'n_points': n_points}).to_csv(
+            os.path.join(plot_dir, 'columns.csv'))
+        status = {
+            'plotid': plotid,
+            'status': 'done',
+            'points': int(n_points.sum()),
+            'seconds': time.perf_counter() - start,
+        }
+    except Exception as e:
+        return {
+            'plotid': plotid,
+            'status': 'failed',
+            'seconds': time.perf_counter() - start,
+            'error': repr(e),
+        }
+    tmp_file = os.path.join(plot_dir, STATUS_FILE + '.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp_file, os.path.join(plot_dir, STATUS_FILE))
+    return status
+
+
+def run(plot_table, cloud, output_dir, plots=None, dxy=1., dz=0.25,
+        chunk_size=1000000, workers=None, force=False, raster_res=0.2):
+    """ Process every plot of plot_table in a process pool and return the
+    per-plot status dicts, in table order """
+    rows = read_plot_table(plot_table, plots)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                process_plot, plotid, corners, cloud, output_dir, dxy, dz,
+                chunk_size, force, raster_res)
+            for plotid, corners in rows]
+        summary = []
+        for future in futures:
+            status = future.result()
+            print('{plotid:>10} {status:>8} {0:10.2f} s'.format(
+                status.get('seconds', 0.0), **status))
+            summary.append(status)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Crop, transform and bin every plot of a plot table.')
+    parser.add_argument('cloud',
+                        help="source cloud; '{plotid}' is replaced by the "
+                             "plot id")
+    parser.add_argument('--table', default='uhu_pdal_pointcloud_params.csv')
+    parser.add_argument('--plots', nargs='+', default=None,
+                        help='plot id prefixes to process [default: all]')
+    parser.add_argument('-o', '--output-dir', default='plot_products')
+    parser.add_argument('--dxy', type=float, default=1.)
+    parser.add_argument('--dz', type=float, default=0.25)
+    parser.add_argument('--raster-res', type=float, default=0.2,
+                        help='CHM/DTM raster resolution; 0 to skip them')
+    parser.add_argument('--chunk-size', type=int, default=1000000)
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true',
+                        help='reprocess plots that are already complete')
+    parser.add_argument('--summary', default=None,
+                        help='write the per-plot summary to this csv file')
+    args = parser.parse_args(argv)
+
+    summary = run(args.table, args.cloud, args.output_dir, args.plots,
+                  args.dxy, args.dz, args.chunk_size, args.workers,
+                  args.force, args.raster_res)
+    if args.summary:
+        pd.DataFrame(summary).to_csv(args.summary, index=False)
+    failed = [s['plotid'] for s in summary if s['status'] == 'failed']
+    print('{} plots, {} failed.'.format(len(summary), len(failed)))
+
+
+if __name__ == "__main__":
+    main()
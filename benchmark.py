@@ -0,0 +1,282 @@
+########################################################################
+#
+# benchmark.py - timing and memory benchmarks for random_field stages
+#
+# each (stage, size) case runs headless in a fresh process on synthetic
+# domain.txt / seeds.txt inputs; wall time, peak RSS and throughput are
+# written to a JSON results file that can be compared across commits
+#
+########################################################################
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue as queue_module
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+# stage name -> unit of the size parameter
+STAGES = {
+    'ReadSeeds': 'points',
+    'Spawn': 'points',
+    'InvDistSquared': 'points',
+    'InvDistBatch': 'points',
+    'InterpGrid': 'cells',
+    'ApplySlope': 'cells',
+    'Stretch': 'cells',
+    'Bin': 'cells',
+    'WriteOutput': 'cells',
+    'WriteNpy': 'cells',
+    'Nodes': 'cells',
+}
+
+DEFAULT_SIZES = {
+    'points': [1000, 10000],
+    'cells': [10000, 1000000],
+}
+
+# number of neighbours used for the inverse-distance stages
+K_NEIGHBOURS = 30
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return rss/2.0**20 if sys.platform == 'darwin' else rss/2.0**10
+
+
+def write_domain(path, cells):
+    """ Write a domain.txt with roughly `cells` cells on a 100 x 100 plan """
+    nz = 1 if cells <= 1e6 else int(round(cells**(1/3.0)))
+    nxy = int(round(np.sqrt(cells/float(nz))))
+    with open(path, 'w') as f:
+        f.write('\tX\tY\tZ\n')
+        f.write('start\t0.0\t0.0\t0.0\n')
+        f.write('end\t100.0\t100.0\t{}\n'.format(float(nz)))
+        f.write('N\t{0}\t{0}\t{1}\n'.format(nxy, nz))
+        f.write('anisotrophy_(0-1)\t1.0\t0.2\t1.0\n')
+        f.write('slope\t0.01\t0.0\n')
+
+
+def write_seeds(path, n, rng):
+    pts = rng.uniform(0.0, 100.0, (n, 3))
+    pts[:, 2] = rng.uniform(0.0, 1.0, n)
+    values = rng.uniform(-3.0, 1.5, n)
+    with open(path, 'w') as f:
+        f.write('x\ty\tz\tvalue\n')
+        for p, v in zip(pts, values):
+            f.write('{}\t{}\t{}\t{}\n'.format(p[0], p[1], p[2], v))
+
+
+def run_case(stage, size, workdir):
+    """ Set up and time one stage; returns a result dict.
+
+    Runs inside a fresh process so that peak RSS belongs to this case.
+    """
+    os.chdir(workdir)
+    import random_field as rf
+    from scipy.spatial import cKDTree
+    rng = np.random.default_rng(0)
+    unit = STAGES[stage]
+    params = rf.Params()
+    write_domain('domain.txt', size if unit == 'cells' else 10000)
+    grid = rf.Grid('domain.txt')
+    n_seeds = size if stage == 'ReadSeeds' else 100
+    write_seeds('seeds.txt', n_seeds, rng)
+
+    # stage set-up, excluded from the timings
+    if stage == 'ReadSeeds':
+        params.num_extra_seeds = 0
+    elif stage == 'Spawn':
+        params.max_pts = size
+        pts, v = rf.ReadSeeds(params, grid, rng=rng)
+    elif stage in ('InvDistSquared', 'InvDistBatch'):
+        pts = rng.uniform(0.0, 100.0, (size, 3))
+        v = rng.uniform(-3.0, 1.5, size)
+        P = rng.uniform(0.0, 100.0, (size, 3))
+        _, near = cKDTree(pts).query(P, k=K_NEIGHBOURS)
+    else:
+        pts = rng.uniform(0.0, 100.0, (30000, 3))
+        v = rng.uniform(-3.0, 1.5, 30000)
+        if stage != 'InterpGrid':
+            grid.InterpGrid(pts, v)
+    out_file = os.path.join(workdir, 'out')
+    rss_before = peak_rss_mb()
+
+    start = time.perf_counter()
+    if stage == 'ReadSeeds':
+        rf.ReadSeeds(params, grid, rng=rng)
+    elif stage == 'Spawn':
+        rf.Spawn(params, grid, pts, v, rng=rng)
+    elif stage == 'InvDistSquared':
+        for i in range(size):
+            rf.InvDistSquared(
+                P[i], pts[near[i]], v[near[i]], grid.tensor,
+                params.exp_gen, params.epsilon)
+    elif stage == 'InvDistBatch':
+        rf.InvDistBatch(
+            P, pts, v, grid.tensor, params.exp_gen, params.epsilon,
+            np.arange(0, near.size + 1, K_NEIGHBOURS), near.ravel())
+    elif stage == 'InterpGrid':
+        grid.InterpGrid(pts, v)
+    elif stage == 'ApplySlope':
+        grid.ApplySlope()
+        for lo, hi in grid.Chunks():
+            grid.Coords(lo, hi)
+    elif stage == 'Stretch':
+        grid.Stretch(1.0, params.min_value, params.max_value)
+    elif stage == 'Bin':
+        rf.Bin(grid.values, 5)
+    elif stage == 'WriteOutput':
+        rf.WriteOutput(grid.grid, grid.values, out_file + '.txt')
+    elif stage == 'WriteNpy':
+        rf.WriteOutput(grid.grid, grid.values, out_file + '.npy')
+    elif stage == 'Nodes':
+        grid.Nodes(False)
+    wall = time.perf_counter() - start
+
+    return {
+        'stage': stage,
+        'size': size,
+        'unit': unit,
+        'wall_time': wall,
+        'rate': size/wall if wall > 0 else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'setup_rss_mb': rss_before,
+    }
+
+
+def _worker(stage, size, workdir, queue):
+    try:
+        queue.put(run_case(stage, size, workdir))
+    except Exception as e:
+        queue.put({'stage': stage, 'size': size, 'error': repr(e)})
+
+
+def _collect(proc, queue, stage, size, timeout=None, poll=1.0):
+    """ Wait for the result of a case process; a child that dies without
+    reporting (e.g. killed for running out of memory) or that runs past
+    `timeout` seconds gives an error row instead of hanging the harness
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except queue_module.Empty:
+            pass
+        if not proc.is_alive():
+            # the child may have put its result just before exiting
+            try:
+                return queue.get(timeout=poll)
+            except queue_module.Empty:
+                return {'stage': stage, 'size': size,
+                        'error': 'process exited with code {}'.format(
+                            proc.exitcode)}
+        if deadline is not None and time.monotonic() > deadline:
+            proc.terminate()
+            return {'stage': stage, 'size': size,
+                    'error': 'timed out after {} s'.format(timeout)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(stages=None, point_sizes=None, cell_sizes=None,
+                   timeout=None):
+    """ Run every requested (stage, size) case in its own process; a case
+    whose process dies or runs longer than `timeout` seconds is recorded
+    as failed """
+    sizes = {
+        'points': point_sizes or DEFAULT_SIZES['points'],
+        'cells': cell_sizes or DEFAULT_SIZES['cells'],
+    }
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, package_dir)
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for stage in stages or list(STAGES):
+        for size in sizes[STAGES[stage]]:
+            with tempfile.TemporaryDirectory() as workdir:
+                queue = ctx.Queue()
+                proc = ctx.Process(
+                    target=_worker, args=(stage, size, workdir, queue))
+                proc.start()
+                result = _collect(proc, queue, stage, size, timeout)
+                proc.join()
+            results.append(result)
+            if 'error' in result:
+                print('{:>15} {:>10}  failed: {}'.format(
+                    stage, size, result['error']))
+            else:
+                print('{:>15} {:>10}  {:10.4f} s  {:10.1f} MB  {:12.0f} {}/s'.format(  # NOQA
+                    stage, size, result['wall_time'], result['peak_rss_mb'],
+                    result['rate'] or 0, result['unit']))
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.platform(),
+        'results': results,
+    }
+
+
+def compare(baseline_file, results):
+    """ Print wall-time speedups of results relative to a baseline file """
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    old = {(r['stage'], r['size']): r for r in baseline['results']
+           if 'error' not in r}
+    print('speedup vs {}:'.format(baseline.get('commit')))
+    for r in results['results']:
+        key = (r['stage'], r.get('size'))
+        if 'error' in r or key not in old:
+            continue
+        print('{:>15} {:>10}  {:8.2f}x'.format(
+            key[0], key[1], old[key]['wall_time']/r['wall_time']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the random_field pipeline stages.')
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES))
+    parser.add_argument('--points', type=float, nargs='+',
+                        help='point-set sizes [default: 1e3 1e4]')
+    parser.add_argument('--cells', type=float, nargs='+',
+                        help='grid sizes in cells [default: 1e4 1e6]')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds allowed per case [default: no limit]')
+    parser.add_argument('-o', '--output', default='bench_results.json')
+    parser.add_argument('--compare', default=None,
+                        help='earlier results file to compare against')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        args.stages,
+        [int(n) for n in args.points] if args.points else None,
+        [int(n) for n in args.cells] if args.cells else None,
+        args.timeout)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Wrote results to {}.'.format(args.output))
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
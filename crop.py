@@ -0,0 +1,158 @@
+# NumPy equivalent of the PDAL filters.crop / filters.transformation
+# stages for plot polygons, applied chunk by chunk
+import numpy as np
+
+from PDAL import PDAL
+
+
+def parse_polygon(polygon):
+    """ Corner points of a polygon given as a list of [x, y] points or as
+    the WKT string made by PDAL.make_polygon (closing point dropped)
+
+    >>> parse_polygon('POLYGON((0 0, 1 0, 1 1, 0 0))').tolist()
+    [[0.0, 0.0], [1.0, 0.0], [1.0, 1.0]]
+    """
+    if isinstance(polygon, str):
+        body = polygon[polygon.index('((') + 2:polygon.index('))')]
+        polygon = [[float(v) for v in p.split()] for p in body.split(',')]
+    polygon = np.asarray(polygon, dtype=float)
+    if len(polygon) > 1 and np.array_equal(polygon[0], polygon[-1]):
+        polygon = polygon[:-1]
+    return polygon
+
+
+def points_in_polygon(x, y, polygon):
+    """ Even-odd (ray casting) containment test, vectorized over points
+    with one pass per polygon edge. The polygon is closed: points lying
+    exactly on an edge or corner are inside, as for the inclusive bounds
+    test of PlotCrop.
+
+    >>> square = [[0, 0], [2, 0], [2, 2], [0, 2]]
+    >>> points_in_polygon(np.array([1.0, 3.0, 0.5]), np.array([1.0, 1.0, 1.9]), square).tolist()  # NOQA
+    [True, False, True]
+    >>> points_in_polygon(np.array([2.0, 0.0, 1.0, 2.0]), np.array([1.0, 0.0, 2.0, 2.1]), square).tolist()  # NOQA
+    [True, True, True, False]
+    >>> points_in_polygon(np.array([2.5, 2.5]), np.array([0.5, 0.6]), [[0, 0], [3, 0], [0, 3]]).tolist()  # NOQA
+    [True, False]
+    """
+    polygon = parse_polygon(polygon)
+    x = np.asarray(x)
+    y = np.asarray(y)
+    inside = np.zeros(x.shape, dtype=bool)
+    on_edge = np.zeros(x.shape, dtype=bool)
+    for (x0, y0), (x1, y1) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        # collinear with the edge and within its bounding box
+        on_edge |= (
+            ((x1 - x0)*(y - y0) == (y1 - y0)*(x - x0)) &
+            (np.minimum(x0, x1) <= x) & (x <= np.maximum(x0, x1)) &
+            (np.minimum(y0, y1) <= y) & (y <= np.maximum(y0, y1)))
+        if y0 == y1:
+            continue
+        crosses = (y0 > y) != (y1 > y)
+        # x of the edge at each point's y, for the points it spans
+        x_edge = x0 + (y[crosses] - y0)*((x1 - x0)/(y1 - y0))
+        inside[crosses] ^= x[crosses] < x_edge
+    return inside | on_edge
+
+
+class PlotCrop():
+    """ Crops points to a plot polygon in the plot frame of
+    PDAL.transformation_matrix (lower left corner at the origin, lower
+    edge along X).
+
+    Points are moved into the plot frame once and tested against the
+    bounds of the transformed polygon. For a rotated rectangle that is
+    the whole test; other polygons also get the even-odd test, but only
+    for points inside the bounds. The frame coordinates are kept, so crop
+    and transformation share one pass over the data.
+
+    >>> crop = PlotCrop([[2, 0], [4, 2], [2, 4], [0, 2]])
+    >>> crop.rectangle
+    True
+    >>> chunk = np.zeros(3, dtype=[('X', 'f8'), ('Y', 'f8'), ('Z', 'f8')])
+    >>> chunk['X'] = [2.0, 2.0, 3.5]
+    >>> chunk['Y'] = [1.0, 3.9, 3.5]
+    >>> crop.mask(chunk['X'], chunk['Y']).tolist()
+    [True, True, False]
+    >>> cropped = crop.crop(chunk, transform=True)
+    >>> cropped['X'].round(6).tolist(), cropped['Y'].round(6).tolist()
+    ([0.707107, 2.757716], [0.707107, 2.757716])
+
+    Polygons whose lowest corner is also their rightmost have no plot
+    frame (PDAL.rotation_angle would divide by zero); they are tested in
+    map coordinates, and can be cropped but not transformed.
+
+    >>> square = PlotCrop([[2, 0], [2, 2], [0, 2], [0, 0]])
+    >>> square.M is None, square.rectangle
+    (True, True)
+    >>> square.mask(np.array([1.0, 2.5]), np.array([1.0, 1.0])).tolist()
+    [True, False]
+    >>> triangle = PlotCrop([[0, 1], [3, 0], [1, 3]])
+    >>> triangle.mask(np.array([1.0, 2.5, 0.2]), np.array([1.0, 2.5, 0.2])).tolist()  # NOQA
+    [True, False, False]
+    """
+    def __init__(self, polygon, tol=1e-6):
+        self.polygon = parse_polygon(polygon)
+        try:
+            self.M = np.asarray(
+                PDAL.transformation_matrix(self.polygon.tolist()))
+        except ZeroDivisionError:
+            self.M = None
+        self.frame = self.to_frame(self.polygon[:, 0], self.polygon[:, 1])
+        self.frame = np.column_stack(self.frame)
+        self.lo = self.frame.min(axis=0)
+        self.hi = self.frame.max(axis=0)
+        # a rotated rectangle has every corner on its frame bounds
+        on_bounds = (
+            (np.abs(self.frame - self.lo) <= tol) |
+            (np.abs(self.frame - self.hi) <= tol))
+        self.rectangle = bool(len(self.frame) == 4 and on_bounds.all())
+
+    def to_frame(self, x, y):
+        """ Plot-frame coordinates of x, y (unchanged without a frame) """
+        M = self.M
+        if M is None:
+            return x, y
+        return (M[0, 0]*x + M[0, 1]*y + M[0, 3],
+                M[1, 0]*x + M[1, 1]*y + M[1, 3])
+
+    def _mask_frame(self, x, y):
+        u, v = self.to_frame(np.asarray(x), np.asarray(y))
+        mask = (
+            (u >= self.lo[0]) & (u <= self.hi[0]) &
+            (v >= self.lo[1]) & (v <= self.hi[1]))
+        if not self.rectangle:
+            candidates = np.flatnonzero(mask)
+            mask[candidates] = points_in_polygon(
+                u[candidates], v[candidates], self.frame)
+        return mask, u, v
+
+    def mask(self, x, y):
+        """ Boolean mask of the points inside the polygon """
+        return self._mask_frame(x, y)[0]
+
+    def indices(self, x, y):
+        """ Indices of the points inside the polygon """
+        return np.flatnonzero(self.mask(x, y))
+
+    def crop(self, chunk, transform=False):
+        """ The points of a structured chunk inside the polygon; with
+        transform, X and Y are replaced by plot-frame coordinates (Z is
+        unchanged by the plot transformation) """
+        if transform and self.M is None:
+            raise ValueError('polygon has no plot frame to transform to')
+        mask, u, v = self._mask_frame(chunk['X'], chunk['Y'])
+        chunk = chunk[mask]
+        if transform:
+            chunk['X'] = u[mask]
+            chunk['Y'] = v[mask]
+        return chunk
+
+    def crop_chunks(self, chunks, transform=False):
+        for chunk in chunks:
+            yield self.crop(chunk, transform)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,91 @@
+########################################################################
+#
+# ensemble.py - parallel realizations of the random_field generator
+#
+# run N headless realizations of Points() -> Grid.InterpGrid ->
+# Grid.ApplySlope (or of another field engine) across a process pool and
+# stack the gridded values into a single .npy file of shape
+# (N, number of grid cells)
+#
+########################################################################
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from random_field import Params, Grid, FIELD_ENGINES
+
+
+def realization(seed, params=None, domain_file='domain.txt',
+                seed_file='seeds.txt', engine='sequential'):
+    """ Generate one gridded realization without any Tk dialogs or plots.
+
+    seed is anything numpy.random.default_rng accepts (typically a child
+    SeedSequence), so every realization draws from its own stream.
+    engine is a key of random_field.FIELD_ENGINES. Returns the grid
+    values, ordered like Grid.grid.
+    """
+    rng = np.random.default_rng(seed)
+    if params is None:
+        params = Params()
+    grid = Grid(domain_file)
+    FIELD_ENGINES[engine](params, grid, rng=rng, seed_file=seed_file)
+    grid.ApplySlope()
+    return grid.values
+
+
+def ensemble(n, base_seed=0, output_file='ensemble.npy', workers=None,
+             params=None, domain_file='domain.txt', seed_file='seeds.txt',
+             engine='sequential'):
+    """ Run n realizations across a process pool.
+
+    Child seeds are spawned from one SeedSequence(base_seed), so the
+    ensemble is reproducible and realization i is independent of the
+    worker count. Rows are written to a memory-mapped .npy file as they
+    complete; the open memmap is returned.
+    """
+    seeds = np.random.SeedSequence(base_seed).spawn(n)
+    grid = Grid(domain_file)
+    out = np.lib.format.open_memmap(
+        output_file, mode='w+', dtype=float, shape=(n, int(grid.N.prod())))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                realization, seed, params, domain_file, seed_file, engine)
+            for seed in seeds]
+        for i, future in enumerate(futures):
+            out[i] = future.result()
+            print('\t... realization {} of {} done.'.format(i + 1, n))
+    out.flush()
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Generate an ensemble of random_field realizations.')
+    parser.add_argument('-n', '--realizations', type=int, default=10)
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='base seed for the ensemble RNG streams')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker processes [default: all cores]')  # NOQA
+    parser.add_argument('-o', '--output', default='ensemble.npy')
+    parser.add_argument('--domain', default='domain.txt')
+    parser.add_argument('--seeds', default='seeds.txt')
+    parser.add_argument('--max-pts', type=int, default=None)
+    parser.add_argument('--engine', choices=sorted(FIELD_ENGINES),
+                        default='sequential')
+    args = parser.parse_args(argv)
+
+    params = Params()
+    if args.max_pts is not None:
+        params.max_pts = args.max_pts
+    ensemble(
+        args.realizations, base_seed=args.seed, output_file=args.output,
+        workers=args.workers, params=params, domain_file=args.domain,
+        seed_file=args.seeds, engine=args.engine)
+    print('Wrote {} realizations to {}.'.format(args.realizations, args.output))  # NOQA
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+# Ground surface estimation and height normalization for point clouds
+import numpy as np
+from scipy.interpolate import griddata
+from scipy.ndimage import binary_dilation, grey_opening, map_coordinates
+from scipy.spatial import QhullError, cKDTree
+
+from pointcloud_io import PointCache
+from voxel import VoxelAccumulator, cell_index, pack_keys, unpack_keys
+
+
+class GroundSurface():
+    """ A ground elevation raster with cell size `resolution`.
+
+    elevation[i, j] is the ground elevation of the cell with indices
+    origin + (i, j), i.e. the cell whose lower left corner is at
+    (origin + (i, j))*resolution.
+    """
+    def __init__(self, elevation, origin, resolution):
+        self.elevation = elevation
+        self.origin = np.asarray(origin)
+        self.resolution = resolution
+
+    def sample(self, x, y):
+        """ Bilinear ground elevation at x, y (clamped at the edges)
+
+        >>> surface = GroundSurface(np.array([[0., 1.], [2., 3.]]), [0, 0], 1.0)  # NOQA
+        >>> surface.sample(np.array([0.5, 1.0, 1.5]), np.array([0.5, 1.0, 1.5])).tolist()  # NOQA
+        [0.0, 1.5, 3.0]
+        """
+        # fractional raster coordinates, relative to cell centres
+        i = np.asarray(x)/self.resolution - self.origin[0] - 0.5
+        j = np.asarray(y)/self.resolution - self.origin[1] - 0.5
+        return map_coordinates(
+            self.elevation, [i, j], order=1, mode='nearest')
+
+
+def ground_minima(x, y, z, resolution=0.1, chunk_size=1000000):
+    """ Minimum z of every occupied cell, with one sort per chunk.
+
+    Returns the (ix, iy) cell indices of the occupied cells and their
+    minimum elevations.
+    """
+    minima = VoxelAccumulator(('min',))
+    for start in range(0, len(z), chunk_size):
+        stop = start + chunk_size
+        minima.add(pack_keys(
+            cell_index(x[start:stop], resolution),
+            cell_index(y[start:stop], resolution)), z[start:stop])
+    ix, iy = unpack_keys(minima.result['keys'], 2)
+    return ix, iy, minima.result['min']
+
+
+def ground_surface(x, y, z, resolution=0.1, method='linear', tile_size=500,
+                   overlap=20, chunk_size=1000000):
+    """ Interpolate a ground surface from per-cell minimum elevations.
+
+    The absolute minimum elevation in every cell is assumed to be
+    ground. Cells without points are filled with
+    `scipy.interpolate.griddata` one tile of tile_size x tile_size cells
+    at a time, using the minima within `overlap` cells of the tile so
+    that neighbouring tiles agree at their edges. Cells outside the
+    convex hull of the local minima take the nearest minimum.
+    """
+    ix, iy, zmin = ground_minima(x, y, z, resolution, chunk_size)
+    origin = np.array([ix.min(), iy.min()])
+    shape = (int(ix.max() - origin[0] + 1), int(iy.max() - origin[1] + 1))
+    elevation = np.full(shape, np.nan, dtype=np.float32)
+    elevation[ix - origin[0], iy - origin[1]] = zmin
+    return GroundSurface(
+        fill_surface(elevation, method, tile_size, overlap), origin,
+        resolution)
+
+
+def fill_surface(elevation, method='linear', tile_size=500, overlap=20):
+    """ Fill the nan cells of a raster with `scipy.interpolate.griddata`,
+    one tile of tile_size x tile_size cells at a time, using the known
+    cells within `overlap` cells of the tile so that neighbouring tiles
+    agree at their edges. Cells outside the convex hull of the local known
+    cells take the nearest known value. Returns a filled copy.
+
+    >>> fill_surface(np.array([[0.0, np.nan, 2.0], [0.0, 1.0, 2.0]])).tolist()
+    [[0.0, 1.0, 2.0], [0.0, 1.0, 2.0]]
+    """
+    shape = elevation.shape
+    known = ~np.isnan(elevation)
+    filled = elevation.copy()
+    for i0 in range(0, shape[0], tile_size):
+        for j0 in range(0, shape[1], tile_size):
+            core = (slice(i0, min(i0 + tile_size, shape[0])),
+                    slice(j0, min(j0 + tile_size, shape[1])))
+            if known[core].all():
+                continue
+            ext = (slice(max(i0 - overlap, 0), core[0].stop + overlap),
+                   slice(max(j0 - overlap, 0), core[1].stop + overlap))
+            # only known cells bordering the empty cells shape the
+            # interpolation inside them, so triangulate just those
+            sites = known[ext] & binary_dilation(~known[ext], iterations=2)
+            ki, kj = np.nonzero(sites)
+            if len(ki) == 0:
+                continue
+            ki += ext[0].start
+            kj += ext[1].start
+            qi, qj = np.nonzero(~known[core])
+            qi += i0
+            qj += j0
+            try:
+                values = griddata(
+                    (ki, kj), elevation[ki, kj], (qi, qj), method=method)
+            except QhullError:
+                # too few (or collinear) known cells to triangulate
+                values = np.full(len(qi), np.nan)
+            missing = np.isnan(values)
+            if missing.any():
+                values[missing] = griddata(
+                    (ki, kj), elevation[ki, kj],
+                    (qi[missing], qj[missing]), method='nearest')
+            filled[qi, qj] = values
+    return filled
+
+
+# PDAL filters.smrf defaults; PDAL.make_pdal_params supplies slope,
+# window, threshold and scalar per plot
+SMRF_DEFAULTS = {
+    'slope': 0.15,
+    'window': 18.0,
+    'threshold': 0.5,
+    'scalar': 1.25,
+    'cell': 1.0,
+}
+
+
+def _disk(radius):
+    i, j = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    return i*i + j*j <= radius*radius
+
+
+def smrf_surface(x, y, z, params=None, chunk_size=1000000, **kwargs):
+    """ Provisional ground surface of the Simple Morphological Filter
+    (Pingel et al. 2013).
+
+    The minimum elevation raster (cell size `cell`) is opened with disks
+    of radius 1, 2, ... window/cell cells; a cell whose elevation drops
+    by more than slope * radius * cell in one opening is an object. The
+    object cells are removed and the ground is interpolated across them.
+
+    params is a dict like PDAL.make_pdal_params()['pipeline'], overridden
+    by keyword arguments; missing values take SMRF_DEFAULTS. Returns the
+    GroundSurface and its slope (rise over run) raster.
+    """
+    params = {**SMRF_DEFAULTS, **(params or {}), **kwargs}
+    cell = float(params['cell'])
+    slope = float(params['slope'])
+    ix, iy, zmin = ground_minima(x, y, z, cell, chunk_size)
+    origin = np.array([ix.min(), iy.min()])
+    shape = (int(ix.max() - origin[0] + 1), int(iy.max() - origin[1] + 1))
+    minimum = np.full(shape, np.nan)
+    minimum[ix - origin[0], iy - origin[1]] = zmin
+    surface = fill_surface(minimum)
+    objects = np.zeros(shape, dtype=bool)
+    for radius in range(1, int(np.ceil(float(params['window'])/cell)) + 1):
+        opened = grey_opening(surface, footprint=_disk(radius))
+        objects |= surface - opened > slope*radius*cell
+        surface = opened
+    minimum[objects] = np.nan
+    ground = fill_surface(minimum)
+    gx, gy = np.gradient(ground, cell) if min(shape) > 1 else (0.0, 0.0)
+    return GroundSurface(ground, origin, cell), np.hypot(gx, gy)
+
+
+def smrf(x, y, z, params=None, chunk_size=1000000, **kwargs):
+    """ Simple Morphological Filter ground classification: True for the
+    points within threshold + scalar * slope of the provisional ground
+    surface (see smrf_surface), classified chunk by chunk.
+
+    >>> gx, gy = np.meshgrid(np.arange(0.5, 20), np.arange(0.5, 20))
+    >>> x, y = gx.ravel(), gy.ravel()
+    >>> z = 0.1*x
+    >>> z[(np.abs(x - 10) < 2) & (np.abs(y - 10) < 2)] += 5.0  # a shrub
+    >>> ground = smrf(x, y, z, {'slope': 0.2, 'window': 5, 'threshold': 0.5})
+    >>> int((~ground).sum()), bool(ground[z < 3].all())
+    (16, True)
+    """
+    params = {**SMRF_DEFAULTS, **(params or {}), **kwargs}
+    surface, gradient = smrf_surface(x, y, z, params, chunk_size)
+    slopes = GroundSurface(gradient, surface.origin, surface.resolution)
+    ground = np.zeros(len(z), dtype=bool)
+    for start in range(0, len(z), chunk_size):
+        stop = start + chunk_size
+        xs, ys = x[start:stop], y[start:stop]
+        ground[start:stop] = np.abs(z[start:stop] - surface.sample(xs, ys)) \
+            <= params['threshold'] + params['scalar']*slopes.sample(xs, ys)
+    return ground
+
+
+def height_above_ground(x, y, z, ground, count=1, max_distance=None,
+                        out=None, chunk_size=1000000, workers=-1):
+    """ Height of every point above the ground points (boolean mask
+    `ground`), as PDAL filters.hag does: Z minus the elevation of the
+    nearest ground point in XY, or the inverse-distance weighted
+    elevation of the `count` nearest.
+
+    The ground points go into one k-d tree, queried chunk by chunk with
+    `workers` threads (-1 for all cores). Ground points get 0. Heights
+    are written to out, which may be z itself to update it in place;
+    points with no ground point within max_distance get nan.
+
+    >>> x = np.array([0.0, 1.0, 0.2, 0.9, 5.0])
+    >>> y = np.zeros(5)
+    >>> z = np.array([10.0, 11.0, 12.5, 11.5, 20.0])
+    >>> ground = np.array([True, True, False, False, False])
+    >>> height_above_ground(x, y, z, ground, max_distance=2.0).tolist()
+    [0.0, 0.0, 2.5, 0.5, nan]
+    >>> height_above_ground(x, y, z, ground, count=2).round(3).tolist()
+    [0.0, 0.0, 2.3, 0.6, 9.444]
+    """
+    if out is None:
+        out = np.empty(len(z))
+    ground = np.flatnonzero(ground)
+    if len(ground) == 0:
+        out[:] = np.nan
+        return out
+    tree = cKDTree(np.column_stack((x[ground], y[ground])))
+    ground_z = np.asarray(z[ground], dtype=float)
+    count = min(count, len(ground))
+    for start in range(0, len(z), chunk_size):
+        stop = start + chunk_size
+        distances, nearest = tree.query(
+            np.column_stack((x[start:stop], y[start:stop])), k=count,
+            workers=workers,
+            distance_upper_bound=np.inf if max_distance is None
+            else max_distance)
+        distances = distances.reshape(len(distances), -1)
+        nearest = nearest.reshape(len(nearest), -1)
+        found = np.isfinite(distances)
+        elevations = ground_z[np.where(found, nearest, 0)]
+        # inverse distance weights; a point on a ground point takes its
+        # elevation
+        with np.errstate(divide='ignore'):
+            weights = np.where(found, 1.0/distances, 0.0)
+        exact = np.isinf(weights)
+        weights[exact.any(axis=1)] = exact[exact.any(axis=1)]
+        with np.errstate(invalid='ignore'):
+            surface = (weights*elevations).sum(axis=1)/weights.sum(axis=1)
+        out[start:stop] = z[start:stop] - surface
+    out[ground] = 0.0
+    return out
+
+
+def adjust_to_ground(points, resolution=0.1, method='linear', tile_size=500,
+                     overlap=20, chunk_size=1000000):
+    """ Makes an interpolated ground surface and re-normalizes vertical
+    elevations based on local ground elevation, in place.
+
+    Usage: surface = adjust_to_ground(points, resolution, method)
+
+        points: structured array, memmap, dict of arrays with X, Y and
+            Z, or a PointCache opened with mode='r+'; Z is replaced by
+            height above the ground surface, chunk by chunk, without
+            copying the cloud
+        resolution: resolution of ground interpolation in meters [0.1 m]
+        method: method for interpolation [default = linear]
+
+    Returns the GroundSurface that was subtracted.
+
+    >>> points = np.zeros(4, dtype=[('X', 'f8'), ('Y', 'f8'), ('Z', 'f8')])
+    >>> points['X'] = [0.05, 0.05, 0.15, 0.15]
+    >>> points['Y'] = [0.05, 0.05, 0.05, 0.05]
+    >>> points['Z'] = [10.0, 12.5, 11.0, 11.25]
+    >>> _ = adjust_to_ground(points, resolution=0.1)
+    >>> points['Z'].tolist()
+    [0.0, 2.5, 0.0, 0.25]
+
+    Quantized caches are rescaled on access, so heights are written back
+    through PointCache.write:
+
+    >>> import tempfile
+    >>> from pointcloud_io import open_cache, point_dtype, write_cache
+    >>> chunk = np.zeros(4, dtype=point_dtype())
+    >>> chunk['X'], chunk['Y'] = [0.05, 0.05, 0.15, 0.15], 0.05
+    >>> chunk['Z'] = [1700.0, 1702.5, 1701.0, 1701.25]
+    >>> cache_dir = tempfile.mkdtemp()
+    >>> _ = write_cache([chunk], cache_dir, scale=0.001)
+    >>> _ = adjust_to_ground(open_cache(cache_dir, mode='r+'), resolution=0.1)
+    >>> cloud = open_cache(cache_dir)
+    >>> cloud['Z'].round(3).tolist(), cloud.header['bounds']['Z']
+    ([0.0, 2.5, 0.0, 0.25], [0.0, 2.5])
+    """
+    cache = isinstance(points, PointCache)
+    if cache:
+        # quantized columns are rescaled chunk by chunk, never in full
+        x, y, z = (points.column(name) for name in ('X', 'Y', 'Z'))
+    else:
+        x, y, z = points['X'], points['Y'], points['Z']
+    surface = ground_surface(
+        x, y, z, resolution, method, tile_size, overlap, chunk_size)
+    lo, hi = np.inf, -np.inf
+    for start in range(0, len(z), chunk_size):
+        stop = start + chunk_size
+        heights = z[start:stop] - surface.sample(
+            x[start:stop], y[start:stop])
+        if len(heights):
+            lo = min(lo, float(heights.min()))
+            hi = max(hi, float(heights.max()))
+        if cache:
+            points.write('Z', heights, start)
+        else:
+            z[start:stop] = heights
+    if cache and len(z):
+        points.header['bounds']['Z'] = [lo, hi]
+        points.save_header()
+    return surface
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
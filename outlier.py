@@ -0,0 +1,59 @@
+# Statistical and radius outlier detection (the PDAL filters.outlier
+# methods) on k-d trees
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def mean_distances(xyz, mean_k=8, workers=-1):
+    """ Mean distance from every point of an N x 3 array to its mean_k
+    nearest neighbours; the queries are spread over `workers` threads
+    (-1 for all cores)
+
+    >>> xyz = np.array([[0.0, 0, 0], [1, 0, 0], [3, 0, 0]])
+    >>> mean_distances(xyz, mean_k=1).tolist()
+    [1.0, 1.0, 2.0]
+    """
+    xyz = np.asarray(xyz, dtype=float)
+    k = min(mean_k, len(xyz) - 1)
+    if k < 1:
+        return np.zeros(len(xyz))
+    # the nearest neighbour of each point is itself, at distance 0
+    distances, _ = cKDTree(xyz).query(xyz, k=k + 1, workers=workers)
+    return distances[:, 1:].mean(axis=1)
+
+
+def statistical_outliers(xyz, mean_k=8, multiplier=2.0, workers=-1):
+    """ Boolean mask of the points whose mean distance to their mean_k
+    nearest neighbours is more than `multiplier` standard deviations
+    above the mean of those distances over all points
+
+    >>> r = np.random.RandomState(0)
+    >>> xyz = np.vstack((r.uniform(0, 10, (500, 3)), [[5, 5, 40]]))
+    >>> np.flatnonzero(statistical_outliers(xyz)).tolist()
+    [500]
+    """
+    distances = mean_distances(xyz, mean_k, workers)
+    if len(distances) == 0:
+        return np.zeros(0, dtype=bool)
+    return distances > distances.mean() + multiplier*distances.std()
+
+
+def radius_outliers(xyz, radius=1.0, min_k=2, workers=-1):
+    """ Boolean mask of the points with fewer than min_k neighbours
+    within radius (the point itself not counted)
+
+    >>> xyz = np.array([[0.0, 0, 0], [0.5, 0, 0], [0.9, 0, 0], [5, 0, 0]])
+    >>> radius_outliers(xyz, radius=1.0, min_k=2).tolist()
+    [False, False, False, True]
+    """
+    xyz = np.asarray(xyz, dtype=float)
+    if len(xyz) == 0:
+        return np.zeros(0, dtype=bool)
+    counts = cKDTree(xyz).query_ball_point(
+        xyz, radius, workers=workers, return_length=True)
+    return counts - 1 < min_k
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
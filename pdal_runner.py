@@ -0,0 +1,168 @@
+########################################################################
+#
+# pdal_runner.py - render and run a PDAL pipeline for every plot
+#
+# the PDAL template is compiled once and rendered for every row of the
+# plot table; the pipelines then run through a pluggable runner (the
+# `pdal pipeline` command, or a stub for testing) with a bounded number
+# of concurrent jobs, skipping plots whose output is newer than both its
+# input cloud and its pipeline file
+#
+########################################################################
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from PDAL import PDAL
+from batch import read_plot_table
+
+
+# one pipeline run: the plot id, its pipeline json and its input and
+# output clouds
+Job = namedtuple('Job', ['plotid', 'pipeline', 'input', 'output'])
+
+
+def render_pipelines(plot_table, cloud, output, pipeline_dir='pipelines',
+                     plots=None, template_file='sfm_cloudprocess.template',
+                     template_dir='templates'):
+    """ Render the PDAL pipeline of every plot in plot_table into
+    pipeline_dir/<plotid>.json and return one Job per plot.
+
+    cloud and output are the input and output cloud paths, in which
+    '{plotid}' is replaced by the plot id. The template is compiled once
+    for all plots, and a pipeline file is only rewritten when its content
+    changes, so unchanged pipelines keep their mtimes.
+    """
+    os.makedirs(pipeline_dir, exist_ok=True)
+    jobs = []
+    for plotid, corners in read_plot_table(plot_table, plots):
+        job = Job(plotid, os.path.join(pipeline_dir, plotid + '.json'),
+                  cloud.format(plotid=plotid), output.format(plotid=plotid))
+        pdal = PDAL(template_file=template_file, points=corners,
+                    template_dir=template_dir)
+        rendered = pdal.render({'input': job.input, 'output': job.output})
+        old = None
+        if os.path.exists(job.pipeline):
+            with open(job.pipeline) as f:
+                old = f.read()
+        if rendered != old:
+            with open(job.pipeline, 'w') as f:
+                f.write(rendered)
+        jobs.append(job)
+    return jobs
+
+
+def up_to_date(job):
+    """ True if the job's output is newer than its input and pipeline """
+    if not os.path.exists(job.output):
+        return False
+    newest = max(os.path.getmtime(job.input), os.path.getmtime(job.pipeline))
+    return os.path.getmtime(job.output) >= newest
+
+
+def pdal_runner(job):
+    """ Run a job's pipeline with the `pdal pipeline` command """
+    subprocess.run(['pdal', 'pipeline', job.pipeline], check=True,
+                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def stub_runner(job):
+    """ Stand-in for pdal_runner that needs no PDAL install: checks that
+    the pipeline is valid JSON naming the job's input and output, then
+    copies the input cloud to the output """
+    with open(job.pipeline) as f:
+        stages = json.load(f)['pipeline']
+    if stages[0] != job.input or stages[-1] != job.output:
+        raise ValueError('pipeline does not read {} and write {}'.format(
+            job.input, job.output))
+    shutil.copyfile(job.input, job.output)
+
+
+RUNNERS = {
+    'pdal': pdal_runner,
+    'stub': stub_runner,
+}
+
+
+def run_job(job, runner=pdal_runner, force=False):
+    """ Run one job unless it is up to date; returns its status dict,
+    which is 'failed' (with the error) if anything goes wrong, e.g. a
+    missing input cloud """
+    start = time.perf_counter()
+    try:
+        if not force and up_to_date(job):
+            return {'plotid': job.plotid, 'status': 'skipped'}
+        runner(job)
+    except Exception as e:
+        error = getattr(e, 'stderr', None) or repr(e)
+        if isinstance(error, bytes):
+            error = error.decode(errors='replace').strip()
+        return {
+            'plotid': job.plotid,
+            'status': 'failed',
+            'seconds': time.perf_counter() - start,
+            'error': error,
+        }
+    return {
+        'plotid': job.plotid,
+        'status': 'done',
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def run_pipelines(jobs, runner=pdal_runner, max_workers=4, force=False):
+    """ Run jobs with at most max_workers at a time and return their
+    status dicts, in job order.
+
+    Each job is an external process (or I/O for the stub), so a thread
+    pool bounds the concurrency without pickling the runner.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(run_job, job, runner, force) for job in jobs]
+        summary = []
+        for future in futures:
+            status = future.result()
+            print('{plotid:>10} {status:>8} {0:10.2f} s'.format(
+                status.get('seconds', 0.0), **status))
+            summary.append(status)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Render and run the PDAL pipeline of every plot.')
+    parser.add_argument('cloud',
+                        help="input cloud; '{plotid}' is replaced by the "
+                             "plot id")
+    parser.add_argument('-o', '--output', default='{plotid}_processed.las',
+                        help="output cloud [default: "
+                             "'{plotid}_processed.las']")
+    parser.add_argument('--table', default='uhu_pdal_pointcloud_params.csv')
+    parser.add_argument('--plots', nargs='+', default=None,
+                        help='plot id prefixes to process [default: all]')
+    parser.add_argument('--pipeline-dir', default='pipelines')
+    parser.add_argument('--template', default='sfm_cloudprocess.template')
+    parser.add_argument('--runner', choices=sorted(RUNNERS), default='pdal')
+    parser.add_argument('-w', '--workers', type=int, default=4)
+    parser.add_argument('--force', action='store_true',
+                        help='rerun pipelines that are up to date')
+    args = parser.parse_args(argv)
+
+    jobs = render_pipelines(args.table, args.cloud, args.output,
+                            args.pipeline_dir, args.plots, args.template)
+    summary = run_pipelines(jobs, RUNNERS[args.runner], args.workers,
+                            args.force)
+    failed = [s for s in summary if s['status'] == 'failed']
+    for status in failed:
+        print('{plotid}: {error}'.format(**status))
+    print('{} pipelines, {} failed.'.format(len(summary), len(failed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,586 @@
+########################################################################
+#
+# pipeline.py - run a rendered sfm_cloudprocess pipeline in NumPy
+#
+# takes the stage list of a PDAL pipeline (e.g. the JSON written by
+# PDAL.write_json) and runs it in process: consecutive stateless stages
+# (assign, range, crop, transformation, ferry) are fused into a single
+# pass over point chunks, and stateful stages (elm, outlier, smrf,
+# hag) run tile by tile, with a halo of neighbouring tiles, in a process
+# pool over a tile index of the cloud written to a work directory
+#
+########################################################################
+
+import argparse
+import json
+import os
+import re
+import shutil
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.ndimage import minimum_filter
+from scipy.spatial import cKDTree
+
+from PDAL import PDAL
+from crop import PlotCrop
+from ground import height_above_ground, smrf
+from outlier import radius_outliers, statistical_outliers
+from pointcloud_io import PointCache, read_chunks, write_cache
+from tile_index import TileIndex, build_index
+from voxel import cell_index, pack_keys
+
+
+# storage types of the dimensions stages may add (others are float64)
+DIMENSION_TYPES = {
+    'Classification': 'u1',
+    'NumberOfReturns': 'u1',
+    'ReturnNumber': 'u1',
+}
+
+# ASPRS classes used by the stages
+NOISE = 7
+GROUND = 2
+
+
+def parse_ranges(text):
+    """ Parse PDAL range syntax, e.g. 'Classification[1:1]' or
+    'Z(0:],Classification![7:7]', into (dimension, lo, hi, lo_open,
+    hi_open, negate) tuples; empty bounds are infinite
+
+    >>> parse_ranges('Classification![7:7], Z(0:]')
+    [('Classification', 7.0, 7.0, False, False, True), ('Z', 0.0, inf, True, False, False)]
+    """
+    ranges = []
+    for match in re.finditer(
+            r'(\w+)\s*(!?)\s*([\[\(])([^:\]\)]*):([^\]\)]*)([\]\)])', text):
+        name, negate, left, lo, hi, right = match.groups()
+        ranges.append((
+            name,
+            float(lo) if lo.strip() else -np.inf,
+            float(hi) if hi.strip() else np.inf,
+            left == '(', right == ')', bool(negate)))
+    return ranges
+
+
+def range_mask(chunk, ranges):
+    """ Points passing PDAL range limits: ranges on the same dimension
+    are OR'd, ranges on different dimensions AND'd; chunk is a structured
+    array or a dict of columns """
+    by_name = {}
+    for name, lo, hi, lo_open, hi_open, negate in ranges:
+        values = chunk[name]
+        mask = (values > lo if lo_open else values >= lo) & \
+            (values < hi if hi_open else values <= hi)
+        if negate:
+            mask = ~mask
+        by_name[name] = by_name.get(name, False) | mask
+    keep = np.ones(len(chunk['X']), dtype=bool)
+    for mask in by_name.values():
+        keep &= mask
+    return keep
+
+
+def _assign(stage):
+    target, condition, value = re.match(
+        r'\s*(\w+)\s*(\S*?)\s*=\s*(.+)', stage['assignment']).groups()
+    ranges = parse_ranges(target + condition) if condition else []
+    value = float(value)
+
+    def assign(chunk):
+        if ranges:
+            chunk[target][range_mask(chunk, ranges)] = value
+        else:
+            chunk[target] = value
+        return chunk
+    return assign
+
+
+def _range(stage):
+    ranges = parse_ranges(stage['limits'])
+
+    def limit(chunk):
+        return chunk[range_mask(chunk, ranges)]
+    return limit
+
+
+def _crop(stage):
+    crop = PlotCrop(stage['polygon'])
+
+    def crop_chunk(chunk):
+        return chunk[crop.mask(chunk['X'], chunk['Y'])]
+    return crop_chunk
+
+
+def transformation_matrix(stage):
+    """ 4 x 4 matrix of a filters.transformation stage ('None' is the
+    identity, as PDAL.make_matrix renders a missing matrix) """
+    if stage['matrix'].strip() == 'None':
+        return np.eye(4)
+    return np.array(stage['matrix'].split(), dtype=float).reshape(4, 4)
+
+
+def _transformation(stage):
+    M = transformation_matrix(stage)
+
+    def transform(chunk):
+        xyz = np.column_stack((chunk['X'], chunk['Y'], chunk['Z']))
+        PDAL.transform_points(xyz, M, out=xyz)
+        chunk['X'] = xyz[:, 0]
+        chunk['Y'] = xyz[:, 1]
+        chunk['Z'] = xyz[:, 2]
+        return chunk
+    return transform
+
+
+def _ferry_pairs(stage):
+    pairs = []
+    for pair in stage['dimensions'].split(','):
+        source, target = re.split(r'\s*=>?\s*', pair.strip())
+        pairs.append((source, target))
+    return pairs
+
+
+def _ferry(stage):
+    pairs = _ferry_pairs(stage)
+
+    def ferry(chunk):
+        for source, target in pairs:
+            chunk[target] = chunk[source]
+        return chunk
+    return ferry
+
+
+# stage type -> factory of a chunk -> chunk function
+STATELESS_STAGES = {
+    'filters.assign': _assign,
+    'filters.range': _range,
+    'filters.crop': _crop,
+    'filters.transformation': _transformation,
+    'filters.ferry': _ferry,
+}
+
+
+def elm(points, stage):
+    """ Extended local minimum: the lowest point of a cell is low noise
+    if it lies more than `threshold` below the lowest point of every
+    neighbouring cell; repeated until no more points are flagged.
+
+    >>> points = {'X': np.array([0.5, 0.6, 1.5, 2.5, 1.5]),
+    ...           'Y': np.array([0.5, 0.5, 0.5, 0.5, 1.5]),
+    ...           'Z': np.array([-9.0, 1.0, 1.1, 0.9, 1.0]),
+    ...           'Classification': np.zeros(5, dtype='u1')}
+    >>> elm(points, {'cell': 1.0, 'threshold': 0.5})['Classification'].tolist()  # NOQA
+    [7, 0, 0, 0, 0]
+    """
+    cell = float(stage.get('cell', 10.0))
+    threshold = float(stage.get('threshold', 1.0))
+    classification = points['Classification'].copy()
+    z = points['Z']
+    ix = cell_index(points['X'], cell)
+    iy = cell_index(points['Y'], cell)
+    ix -= ix.min()
+    iy -= iy.min()
+    keys = pack_keys(ix, iy)
+    shape = (int(ix.max()) + 1, int(iy.max()) + 1)
+    ring = np.ones((3, 3), dtype=bool)
+    ring[1, 1] = False
+    # sort once by cell, then by elevation, so the lowest point still in
+    # play is the first live point of each cell's run
+    order = np.lexsort((z, keys))
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(
+        np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+    cx, cy = ix[order[starts]], iy[order[starts]]
+    positions = np.arange(len(order))
+    while True:
+        live = classification[order] != NOISE
+        first = np.minimum.reduceat(
+            np.where(live, positions, len(order)), starts)
+        occupied = first < len(order)
+        lowest = order[first[occupied]]
+        minima = np.full(shape, np.inf)
+        minima[cx[occupied], cy[occupied]] = z[lowest]
+        neighbours = minimum_filter(
+            minima, footprint=ring, mode='constant', cval=np.inf)
+        below = neighbours[cx[occupied], cy[occupied]] - z[lowest]
+        noise = lowest[np.isfinite(below) & (below > threshold)]
+        if len(noise) == 0:
+            break
+        classification[noise] = NOISE
+    return {'Classification': classification}
+
+
+def outlier(points, stage):
+    """ filters.outlier: flag statistical (or, with method 'radius',
+    isolated) outliers as class `class` (7, noise, by default).
+
+    Run tile by tile, every point of a tile has its full mean_k nearest
+    neighbours (see _outlier_halo), but the mean and standard deviation
+    of the neighbour distances are those of the tile and its halo rather
+    than of the whole cloud, so the threshold follows the local density.
+
+    >>> r = np.random.RandomState(0)
+    >>> points = {name: r.uniform(0, 10, 200) for name in 'XYZ'}
+    >>> points['Z'][10] = 50.0
+    >>> points['Classification'] = np.zeros(200, dtype='u1')
+    >>> classes = outlier(points, {})['Classification']
+    >>> np.flatnonzero(classes).tolist(), int(classes[10])
+    ([10], 7)
+    """
+    xyz = np.column_stack((points['X'], points['Y'], points['Z']))
+    # tiles already run in parallel processes, so each queries on one core
+    if stage.get('method', 'statistical') == 'radius':
+        mask = radius_outliers(xyz, float(stage.get('radius', 1.0)),
+                               int(stage.get('min_k', 2)), workers=1)
+    else:
+        mask = statistical_outliers(xyz, int(stage.get('mean_k', 8)),
+                                    float(stage.get('multiplier', 2.0)),
+                                    workers=1)
+    classification = points['Classification'].copy()
+    classification[mask] = int(stage.get('class', NOISE))
+    return {'Classification': classification}
+
+
+def _outlier_halo(stage, points=None, own=0):
+    # radius mode needs `radius` around the tile. A statistical tile's
+    # halo must hold the mean_k nearest neighbours of its points, which
+    # depends on the density: without points this returns None, and
+    # _run_tile passes the points loaded so far (the tile's own first)
+    # to get an upper bound, the largest distance from one of the own
+    # points to its mean_k-th neighbour among them (inf if too few)
+    if stage.get('method', 'statistical') == 'radius':
+        return float(stage.get('radius', 1.0))
+    if points is None:
+        return None
+    k = int(stage.get('mean_k', 8))
+    if own == 0:
+        return 0.0
+    if len(points['X']) <= k:
+        return np.inf
+    xyz = np.column_stack((points['X'], points['Y'], points['Z']))
+    distances, _ = cKDTree(xyz).query(xyz[:own], k=k + 1, workers=1)
+    return float(distances[:, -1].max())
+
+
+def ground(points, stage):
+    """ filters.smrf: classify the points outside the `ignore` ranges as
+    ground (2) or, like the template's later Classification[1:1] range
+    expects, unclassified (1) with ground.smrf
+
+    >>> gx, gy = np.meshgrid(np.arange(0.5, 10), np.arange(0.5, 10))
+    >>> points = {'X': gx.ravel(), 'Y': gy.ravel(), 'Z': np.zeros(100),
+    ...           'Classification': np.zeros(100, dtype='u1')}
+    >>> points['Z'][55] = 4.0
+    >>> points['Classification'][0] = 7
+    >>> classes = ground(points, {'ignore': 'Classification[7:7]'})
+    >>> np.bincount(classes['Classification']).tolist()
+    [0, 1, 98, 0, 0, 0, 0, 1]
+    """
+    classification = points['Classification'].copy()
+    use = np.ones(len(classification), dtype=bool)
+    if stage.get('ignore'):
+        use = ~range_mask(points, parse_ranges(stage['ignore']))
+    if use.any():
+        params = {name: float(stage[name])
+                  for name in ('slope', 'window', 'threshold', 'scalar',
+                               'cell') if name in stage}
+        is_ground = smrf(points['X'][use], points['Y'][use],
+                         points['Z'][use], params)
+        classification[use] = np.where(is_ground, GROUND, 1)
+    return {'Classification': classification}
+
+
+def hag(points, stage):
+    """ filters.hag: HeightAboveGround over the nearest ground (class 2)
+    point, with ground.height_above_ground
+
+    >>> points = {'X': np.array([0.0, 1.0, 0.4]), 'Y': np.zeros(3),
+    ...           'Z': np.array([1.0, 2.0, 4.0]),
+    ...           'Classification': np.array([2, 2, 1], dtype='u1')}
+    >>> hag(points, {})['HeightAboveGround'].tolist()
+    [0.0, 0.0, 3.0]
+    """
+    max_distance = stage.get('max_distance')
+    height = height_above_ground(
+        points['X'], points['Y'], points['Z'],
+        points['Classification'] == GROUND, int(stage.get('count', 1)),
+        None if max_distance is None else float(max_distance), workers=1)
+    return {'HeightAboveGround': height}
+
+
+# a stage run tile by tile: function(points, stage) -> dict of updated
+# columns, halo(stage) -> halo width in map units (None if it depends on
+# the points, see _outlier_halo), and the dimensions the function writes
+TiledStage = namedtuple('TiledStage', ['function', 'halo', 'fields'])
+
+STATEFUL_STAGES = {
+    # a tile's edge cells reach up to one cell past the tile (tile_size
+    # need not be a multiple of cell) and ELM compares them with the
+    # ring of cells around them, so the halo is two cells
+    'filters.elm': TiledStage(
+        elm, lambda stage: 2*float(stage.get('cell', 10.0)),
+        ('Classification',)),
+    # radius neighbours within `radius`, or the mean_k nearest
+    # neighbours, wherever they are
+    'filters.outlier': TiledStage(
+        outlier, _outlier_halo, ('Classification',)),
+    # the largest opening reaches `window` beyond a tile's own cells
+    'filters.smrf': TiledStage(
+        ground, lambda stage: float(stage.get('window', 18.0)),
+        ('Classification',)),
+    # ground points are looked up in the surrounding ring of tiles, or as
+    # far as max_distance
+    'filters.hag': TiledStage(
+        hag, lambda stage: float(stage.get('max_distance') or 1.0),
+        ('HeightAboveGround',)),
+}
+
+
+def load_stages(pipeline):
+    """ Stage list, reader and writer file names of a pipeline given as a
+    JSON file, JSON text, dict or list of stages """
+    if isinstance(pipeline, str):
+        if os.path.exists(pipeline):
+            with open(pipeline) as f:
+                pipeline = json.load(f)
+        else:
+            pipeline = json.loads(pipeline)
+    if isinstance(pipeline, dict):
+        pipeline = pipeline['pipeline']
+    pipeline = list(pipeline)
+    reader = writer = None
+    if pipeline and isinstance(pipeline[0], str):
+        reader = pipeline.pop(0)
+    if pipeline and isinstance(pipeline[-1], str):
+        writer = pipeline.pop()
+    for stage in pipeline:
+        if (stage['type'] not in STATELESS_STAGES and
+                stage['type'] not in STATEFUL_STAGES):
+            raise ValueError('unsupported stage: {}'.format(stage['type']))
+    return pipeline, reader, writer
+
+
+def plan(stages):
+    """ Group a stage list into ('stateless', stages) segments, fused into
+    one pass each, and ('stateful', stages) segments that share one tile
+    index; consecutive transformations are merged into one matrix
+
+    >>> stages = [{'type': 'filters.assign', 'assignment': 'Z[:]=0'},
+    ...           {'type': 'filters.elm'}, {'type': 'filters.elm'},
+    ...           {'type': 'filters.transformation', 'matrix': 'None'},
+    ...           {'type': 'filters.transformation', 'matrix': 'None'}]
+    >>> [(kind, len(group)) for kind, group in plan(stages)]
+    [('stateless', 1), ('stateful', 2), ('stateless', 1)]
+    """
+    segments = []
+    for stage in stages:
+        kind = 'stateful' if stage['type'] in STATEFUL_STAGES else 'stateless'
+        if not segments or segments[-1][0] != kind:
+            segments.append((kind, []))
+        group = segments[-1][1]
+        if (group and stage['type'] == 'filters.transformation' and
+                group[-1]['type'] == 'filters.transformation'):
+            M = np.matmul(transformation_matrix(stage),
+                          transformation_matrix(group[-1]))
+            stage = {'type': 'filters.transformation',
+                     'matrix': ' '.join(repr(float(v)) for v in M.ravel())}
+            group.pop()
+        group.append(stage)
+    return segments
+
+
+def dimensions(stages):
+    """ Dimensions the stages write, beyond X, Y and Z """
+    names = []
+    for stage in stages:
+        if stage['type'] == 'filters.assign':
+            names.append(re.match(r'\s*(\w+)', stage['assignment']).group(1))
+        elif stage['type'] == 'filters.ferry':
+            names.extend(target for _, target in _ferry_pairs(stage))
+        elif stage['type'] in STATEFUL_STAGES:
+            names.extend(STATEFUL_STAGES[stage['type']].fields)
+    return [name for i, name in enumerate(names)
+            if name not in names[:i] and name not in ('X', 'Y', 'Z')]
+
+
+def _widen(chunks, names):
+    # add zeroed dimensions to every chunk, once, up front
+    for chunk in chunks:
+        missing = [name for name in names if name not in chunk.dtype.names]
+        if missing:
+            wide = np.zeros(len(chunk), dtype=chunk.dtype.descr + [
+                (name, DIMENSION_TYPES.get(name, 'f8')) for name in missing])
+            for name in chunk.dtype.names:
+                wide[name] = chunk[name]
+            chunk = wide
+        yield chunk
+
+
+def _fused(chunks, stages):
+    functions = [STATELESS_STAGES[stage['type']](stage) for stage in stages]
+    for chunk in chunks:
+        for function in functions:
+            chunk = function(chunk)
+        yield chunk
+
+
+def _run_tile(index_dir, tile, stage, halo):
+    # run a stateful stage on one tile plus the tiles within its halo and
+    # write the results for the tile's own points to the .next columns
+    index = TileIndex(index_dir)
+    tiles = index.tiles
+    spec = STATEFUL_STAGES[stage['type']]
+    start, stop = tiles['start'][tile], tiles['stop'][tile]
+    # all the tiles lie within this many tiles of this one
+    widest = int(max(
+        np.abs(tiles['ix'] - tiles['ix'][tile]).max(),
+        np.abs(tiles['iy'] - tiles['iy'][tile]).max()))
+    reach = None if halo is None else int(np.ceil(halo/index.tile_size))
+    while True:
+        near = np.flatnonzero(
+            (np.abs(tiles['ix'] - tiles['ix'][tile]) <= (reach or 1)) &
+            (np.abs(tiles['iy'] - tiles['iy'][tile]) <= (reach or 1)))
+        near = np.concatenate(([tile], near[near != tile]))
+        points = {
+            name: np.concatenate([
+                index.raw(name)[tiles['start'][t]:tiles['stop'][t]]
+                for t in near])
+            for name in index.fields}
+        if halo is not None or (reach or 1) >= widest:
+            break
+        # the bound from the points loaded so far holds for the whole
+        # cloud, so at most one more load is needed
+        needed = spec.halo(stage, points, stop - start)
+        if needed <= (reach or 1)*index.tile_size:
+            break
+        reach = (2*(reach or 1) if not np.isfinite(needed) else
+                 int(np.ceil(needed/index.tile_size)))
+        reach = min(reach, widest)
+    updates = spec.function(points, stage)
+    for name, values in updates.items():
+        column = np.memmap(
+            os.path.join(index_dir, name + '.next.bin'), mode='r+',
+            dtype=index.header['fields'][name]['dtype'], shape=(len(index),))
+        column[start:stop] = values[:stop - start]
+        column.flush()
+
+
+def _run_stateful(index_dir, stage, workers=None):
+    # results go to double-buffered .next files, so no tile ever reads a
+    # neighbour's half-updated halo, and replace the columns at the end
+    index = TileIndex(index_dir)
+    spec = STATEFUL_STAGES[stage['type']]
+    for name in spec.fields:
+        shutil.copyfile(os.path.join(index_dir, name + '.bin'),
+                        os.path.join(index_dir, name + '.next.bin'))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_run_tile, index_dir, tile, stage, spec.halo(stage))
+            for tile in range(len(index.tiles['start']))]
+        for future in futures:
+            future.result()
+    for name in spec.fields:
+        os.replace(os.path.join(index_dir, name + '.next.bin'),
+                   os.path.join(index_dir, name + '.bin'))
+
+
+def run_pipeline(pipeline, source=None, output=None, work_dir=None,
+                 tile_size=25.0, chunk_size=1000000, workers=None):
+    """ Run a PDAL pipeline in process.
+
+    source and output default to the pipeline's reader and writer file
+    names. source is anything pointcloud_io.read_chunks reads; output is
+    written as a pointcloud_io cache directory. Stateful stages work on a
+    tile index of tile_size tiles in work_dir (a temporary directory by
+    default, removed afterwards). Returns the output PointCache.
+
+    Tiled stages give the same result as on the whole cloud, e.g. ELM
+    with tiles that are not a multiple of its cell size:
+
+    >>> from pointcloud_io import point_dtype, write_cache
+    >>> r = np.random.RandomState(5)
+    >>> chunk = np.zeros(1000, dtype=point_dtype())
+    >>> chunk['X'], chunk['Y'] = r.uniform(0, 20, (2, 1000))
+    >>> chunk['Z'] = r.uniform(0, 0.2, 1000) + 0.1*chunk['X']
+    >>> chunk['Z'][:10] -= 2.0
+    >>> work = tempfile.mkdtemp()
+    >>> _ = write_cache([chunk], os.path.join(work, 'src'))
+    >>> stages = [
+    ...     {'type': 'filters.assign', 'assignment': 'Classification[:]=0'},
+    ...     {'type': 'filters.elm', 'cell': 4.0, 'threshold': 0.5}]
+    >>> cloud = run_pipeline(
+    ...     stages, os.path.join(work, 'src'), os.path.join(work, 'out'),
+    ...     tile_size=5.0, workers=1)
+    >>> points = {name: np.asarray(cloud[name]) for name in 'XYZ'}
+    >>> points['Classification'] = np.zeros(len(cloud), dtype='u1')
+    >>> untiled = elm(points, stages[1])['Classification']
+    >>> bool((np.asarray(cloud['Classification']) == untiled).all())
+    True
+
+    The statistical outlier halo grows until every point of a tile has
+    its mean_k nearest neighbours, however sparse its surroundings:
+
+    >>> chunk['Z'][500] = 30.0
+    >>> _ = write_cache([chunk], os.path.join(work, 'src2'))
+    >>> cloud = run_pipeline(
+    ...     [stages[0], {'type': 'filters.outlier'}],
+    ...     os.path.join(work, 'src2'), os.path.join(work, 'out2'),
+    ...     tile_size=2.0, workers=1)
+    >>> spike = np.asarray(cloud['Z']) == 30.0
+    >>> np.asarray(cloud['Classification'])[spike].tolist()
+    [7]
+    """
+    stages, reader, writer = load_stages(pipeline)
+    source = source or reader
+    output = output or writer
+    if source is None or output is None:
+        raise ValueError('the pipeline needs an input and an output cloud')
+    keep_work_dir = work_dir is not None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='pipeline_')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        chunks = _widen(read_chunks(source, chunk_size), dimensions(stages))
+        for i, (kind, group) in enumerate(plan(stages)):
+            if kind == 'stateless':
+                chunks = _fused(chunks, group)
+                continue
+            cache_dir = os.path.join(work_dir, 'segment_{}_cache'.format(i))
+            index_dir = os.path.join(work_dir, 'segment_{}'.format(i))
+            write_cache(chunks, cache_dir)
+            build_index(cache_dir, index_dir, tile_size, chunk_size)
+            shutil.rmtree(cache_dir)
+            for stage in group:
+                _run_stateful(index_dir, stage, workers)
+            chunks = TileIndex(index_dir).chunks(chunk_size)
+        write_cache(chunks, output)
+    finally:
+        if not keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return PointCache(output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a rendered PDAL pipeline with NumPy operators.')
+    parser.add_argument('pipeline', help='pipeline JSON file')
+    parser.add_argument('-i', '--input', default=None,
+                        help="input cloud [default: the pipeline's reader]")
+    parser.add_argument('-o', '--output', default=None,
+                        help="output cache directory [default: the "
+                             "pipeline's writer]")
+    parser.add_argument('--tile-size', type=float, default=25.0)
+    parser.add_argument('--chunk-size', type=int, default=1000000)
+    parser.add_argument('--work-dir', default=None)
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+    cloud = run_pipeline(args.pipeline, args.input, args.output,
+                         args.work_dir, args.tile_size, args.chunk_size,
+                         args.workers)
+    print('Wrote {} points to {}.'.format(len(cloud), cloud.cache_dir))
+
+
+if __name__ == "__main__":
+    main()
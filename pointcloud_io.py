@@ -0,0 +1,313 @@
+# Streaming readers for SfM point clouds (LAS and comma-separated xyz/csv)
+# and a memory-mapped columnar cache for them
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+XYZ_DTYPE = [('X', 'f8'), ('Y', 'f8'), ('Z', 'f8')]
+RGB_DTYPE = [('Red', 'u2'), ('Green', 'u2'), ('Blue', 'u2')]
+
+
+def point_dtype(rgb=False):
+    """ Structured dtype of the chunks yielded by the readers """
+    return np.dtype(XYZ_DTYPE + RGB_DTYPE if rgb else XYZ_DTYPE)
+
+
+def read_las_chunks(filename, chunk_size=1000000, rgb=False):
+    """ Yield chunks of a LAS file as structured arrays of scaled X, Y, Z
+    (and Red, Green, Blue if rgb is True).
+
+    Coordinates are computed from the stored integers with the header
+    scale and offset. Works with laspy 2.x (chunk_iterator) and falls
+    back to slicing the memory-mapped points of laspy 1.x.
+    """
+    import laspy
+    dtype = point_dtype(rgb)
+    if hasattr(laspy, 'open'):
+        with laspy.open(filename) as las_file:
+            scale = las_file.header.scales
+            offset = las_file.header.offsets
+            for points in las_file.chunk_iterator(chunk_size):
+                yield _las_chunk(points, scale, offset, dtype, rgb)
+    else:
+        las_file = laspy.file.File(filename, mode='r')
+        try:
+            scale = las_file.header.scale
+            offset = las_file.header.offset
+            n = las_file.header.point_records_count
+            for start in range(0, n, chunk_size):
+                stop = min(start + chunk_size, n)
+                yield _las_chunk(
+                    _Slice(las_file, start, stop), scale, offset, dtype, rgb)
+        finally:
+            las_file.close()
+
+
+class _Slice():
+    """ Dimension access to rows start:stop of a laspy 1.x File """
+    def __init__(self, las_file, start, stop):
+        self.las_file = las_file
+        self.start = start
+        self.stop = stop
+
+    def __getattr__(self, name):
+        return getattr(self.las_file, name)[self.start:self.stop]
+
+
+def _las_chunk(points, scale, offset, dtype, rgb):
+    X = points.X
+    chunk = np.empty(len(X), dtype=dtype)
+    chunk['X'] = X*scale[0] + offset[0]
+    chunk['Y'] = points.Y*scale[1] + offset[1]
+    chunk['Z'] = points.Z*scale[2] + offset[2]
+    if rgb:
+        chunk['Red'] = points.red
+        chunk['Green'] = points.green
+        chunk['Blue'] = points.blue
+    return chunk
+
+
+def read_xyz_chunks(filename, chunk_size=1000000, rgb=False, sep=',',
+                    header=True):
+    """ Yield chunks of a delimited xyz(rgb) export as structured arrays.
+
+    The first three columns are taken as X, Y, Z and, if rgb is True, the
+    next three as Red, Green, Blue, whatever the header calls them.
+    """
+    dtype = point_dtype(rgb)
+    usecols = list(range(len(dtype.names)))
+    reader = pd.read_csv(
+        filename, sep=sep, header=0 if header else None, usecols=usecols,
+        chunksize=chunk_size)
+    for frame in reader:
+        values = frame.to_numpy()
+        chunk = np.empty(len(values), dtype=dtype)
+        for i, name in enumerate(dtype.names):
+            chunk[name] = values[:, i]
+        yield chunk
+
+
+def read_chunks(filename, chunk_size=1000000, rgb=False, **kwargs):
+    """ Yield structured-array chunks from a LAS/LAZ or xyz/csv file, or
+    from a cache directory written by write_cache, choosing the reader
+    from the file extension """
+    if os.path.isdir(filename):
+        return PointCache(filename).chunks(chunk_size)
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in ('.las', '.laz'):
+        return read_las_chunks(filename, chunk_size, rgb)
+    return read_xyz_chunks(filename, chunk_size, rgb, **kwargs)
+
+
+CACHE_HEADER = 'header.json'
+
+
+def _quantize(name, values, field):
+    # int32 counts of field['scale'] from field['offset'] (0 until set)
+    counts = np.round((values - (field['offset'] or 0.0))/field['scale'])
+    limits = np.iinfo(np.int32)
+    if len(counts) and (counts.min() < limits.min or
+                        counts.max() > limits.max):
+        raise ValueError(
+            '{} out of int32 range at scale {} from offset {}'.format(
+                name, field['scale'], field['offset']))
+    return counts
+
+
+def write_cache(chunks, cache_dir, scale=None):
+    """ Write a stream of structured-array chunks to a columnar cache.
+
+    Each dimension goes to its own raw little-endian file in cache_dir,
+    described by a small JSON header (fields, dtypes, point count and
+    bounds). If scale is given, X, Y and Z are stored as int32 counts of
+    scale relative to an offset taken from the first non-empty chunk,
+    which halves their size on disk; a ValueError is raised if a later
+    point is more than 2**31 counts away. Returns the header dictionary.
+
+    >>> import tempfile
+    >>> chunk = np.zeros(2, dtype=point_dtype())
+    >>> chunk['X'] = [0.0, 3e6]
+    >>> write_cache([chunk[:0], chunk[:1]], tempfile.mkdtemp(), scale=0.001)['fields']['X']['offset']  # NOQA
+    0.0
+    >>> write_cache([chunk], tempfile.mkdtemp(), scale=0.001)
+    Traceback (most recent call last):
+    ...
+    ValueError: X out of int32 range at scale 0.001 from offset 0.0
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    files = {}
+    header = {'count': 0, 'fields': {}, 'bounds': {}}
+    quantized = []
+    try:
+        for chunk in chunks:
+            if not files:
+                for name in chunk.dtype.names:
+                    dtype = np.dtype(chunk.dtype[name]).newbyteorder('<')
+                    if scale is not None and name in ('X', 'Y', 'Z'):
+                        dtype = np.dtype('<i4')
+                        quantized.append(name)
+                    header['fields'][name] = {
+                        'dtype': dtype.str, 'scale': scale, 'offset': None}
+                    files[name] = open(
+                        os.path.join(cache_dir, name + '.bin'), 'wb')
+            for name, f in files.items():
+                field = header['fields'][name]
+                column = chunk[name]
+                if len(column):
+                    lo, hi = float(column.min()), float(column.max())
+                    bounds = header['bounds'].setdefault(name, [lo, hi])
+                    bounds[0] = min(bounds[0], lo)
+                    bounds[1] = max(bounds[1], hi)
+                if name in quantized:
+                    if field['offset'] is None and len(column):
+                        field['offset'] = float(np.floor(column.min()))
+                    column = _quantize(name, column, field)
+                f.write(np.ascontiguousarray(
+                    column, dtype=field['dtype']).tobytes())
+            header['count'] += len(chunk)
+    finally:
+        for f in files.values():
+            f.close()
+    for name in quantized:
+        # a cloud without points still needs an offset to be read back
+        if header['fields'][name]['offset'] is None:
+            header['fields'][name]['offset'] = 0.0
+    with open(os.path.join(cache_dir, CACHE_HEADER), 'w') as f:
+        json.dump(header, f, indent=2)
+    return header
+
+
+def convert(filename, cache_dir, chunk_size=1000000, rgb=False, scale=None,
+            **kwargs):
+    """ One-time conversion of a LAS or xyz/csv cloud into a cache """
+    return write_cache(
+        read_chunks(filename, chunk_size, rgb, **kwargs), cache_dir, scale)
+
+
+class PointCache():
+    """ Memory-mapped view of a cache written by write_cache.
+
+    Opening only reads the JSON header; each column is memory-mapped the
+    first time it is used, so subsets such as X and Y never touch the
+    other files. Unquantized columns are returned as zero-copy memmaps
+    (writable in place with mode='r+'); quantized X, Y and Z are rescaled
+    on access (use raw() for the stored integers).
+
+    >>> import tempfile
+    >>> cache_dir = tempfile.mkdtemp()
+    >>> chunk = np.zeros(3, dtype=point_dtype())
+    >>> chunk['X'] = [262870.125, 262870.5, 262871.0]
+    >>> _ = write_cache([chunk, chunk[:1]], cache_dir, scale=0.001)
+    >>> cloud = PointCache(cache_dir)
+    >>> len(cloud), cloud.header['bounds']['X']
+    (4, [262870.125, 262871.0])
+    >>> cloud['X'].tolist()
+    [262870.125, 262870.5, 262871.0, 262870.125]
+    >>> [c['X'].tolist() for c in cloud.chunks(3, fields=['X'])]
+    [[262870.125, 262870.5, 262871.0], [262870.125]]
+    """
+    def __init__(self, cache_dir, mode='r'):
+        self.cache_dir = cache_dir
+        self.mode = mode
+        with open(os.path.join(cache_dir, CACHE_HEADER)) as f:
+            self.header = json.load(f)
+        self.fields = list(self.header['fields'])
+        self._maps = {}
+
+    def __len__(self):
+        return self.header['count']
+
+    def raw(self, name):
+        """ The stored column, memory-mapped with the cache's mode """
+        if name not in self._maps:
+            field = self.header['fields'][name]
+            if len(self) == 0:
+                self._maps[name] = np.zeros(0, dtype=field['dtype'])
+            else:
+                self._maps[name] = np.memmap(
+                    os.path.join(self.cache_dir, name + '.bin'),
+                    dtype=field['dtype'], mode=self.mode, shape=(len(self),))
+        return self._maps[name]
+
+    def __getitem__(self, name):
+        return self._scaled(name, self.raw(name))
+
+    def column(self, name):
+        """ A column that is rescaled only as it is sliced: the memmap
+        itself for unquantized columns, a ScaledColumn for quantized X,
+        Y and Z """
+        if self.header['fields'][name]['offset'] is None:
+            return self.raw(name)
+        return ScaledColumn(self, name)
+
+    def write(self, name, values, start=0):
+        """ Store values in a column from row start on, quantizing X, Y
+        and Z as write_cache does; the cache must be opened with
+        mode='r+' """
+        field = self.header['fields'][name]
+        if field['offset'] is not None:
+            values = _quantize(name, values, field)
+        self.raw(name)[start:start + len(values)] = values
+
+    def _scaled(self, name, column):
+        field = self.header['fields'][name]
+        if field['offset'] is None:
+            return column
+        return column*field['scale'] + field['offset']
+
+    def save_header(self):
+        """ Rewrite the JSON header, e.g. after bounds changed """
+        with open(os.path.join(self.cache_dir, CACHE_HEADER), 'w') as f:
+            json.dump(self.header, f, indent=2)
+
+    def chunks(self, chunk_size=1000000, fields=None):
+        """ Yield structured-array chunks of the requested fields, for the
+        functions that consume pointcloud_io chunk iterators """
+        fields = fields or self.fields
+        dtype = [(name, 'f8' if self.header['fields'][name]['offset']
+                  is not None else self.header['fields'][name]['dtype'])
+                 for name in fields]
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            chunk = np.empty(stop - start, dtype=dtype)
+            for name in fields:
+                chunk[name] = self._scaled(name, self.raw(name)[start:stop])
+            yield chunk
+
+
+class ScaledColumn():
+    """ A quantized cache column, rescaled one slice at a time so that
+    chunked readers never build the full float column """
+    def __init__(self, cache, name):
+        self.cache = cache
+        self.name = name
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, key):
+        return self.cache._scaled(self.name, self.cache.raw(self.name)[key])
+
+
+def open_cache(cache_dir, mode='r'):
+    return PointCache(cache_dir, mode)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Convert a LAS or xyz/csv point cloud into a '
+                    'memory-mapped columnar cache.')
+    parser.add_argument('filename')
+    parser.add_argument('cache_dir')
+    parser.add_argument('--rgb', action='store_true')
+    parser.add_argument('--scale', type=float, default=None,
+                        help='store X, Y, Z as int32 multiples of scale')
+    parser.add_argument('--chunk-size', type=int, default=1000000)
+    args = parser.parse_args()
+    header = convert(args.filename, args.cache_dir, args.chunk_size,
+                     args.rgb, args.scale)
+    print('Cached {} points in {}.'.format(header['count'], args.cache_dir))
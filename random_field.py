@@ -6,10 +6,11 @@
 #
 ########################################################################
 
+import os
+import zipfile
+from copy import copy as shallow_copy
 from numpy import *
 from scipy.spatial import *
-from scipy.stats import norm
-from scipy.interpolate import griddata
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from functools import partial
@@ -111,10 +112,10 @@ class Params:
 
 
 class Grid:
-    def __init__(self):
+    def __init__(self, domain_file='domain.txt', dtype=float):
         # read in grid constraints
         line_input = []
-        input_file = open('domain.txt', 'r')
+        input_file = open(domain_file, 'r')
         for line in input_file:
             line_input.append(line.split())
         input_file.close()
@@ -196,14 +197,12 @@ class Grid:
         self.xg = arange(self.start[0], self.end[0], self.dl[0]) + 0.5*self.dl[0]  # NOQA
         self.yg = arange(self.start[1], self.end[1], self.dl[1]) + 0.5*self.dl[1]  # NOQA
         self.zg = arange(self.start[2], self.end[2], self.dl[2]) + 0.5*self.dl[2]  # NOQA
-        self.X, self.Y, self.Z = meshgrid(
-            self.xg,
-            self.yg,
-            self.zg,
-            indexing='ij',)
-        self.grid = array(
-            [self.X.flatten(), self.Y.flatten(), self.Z.flatten()]).T
-        self.values = zeros(self.N.prod(), float)                 # placeholder
+        # cell-centre coordinates are computed on demand (see Coords), so
+        # only the values array scales with the size of the domain
+        self.sloped = False
+        self.chunk = 1000000                    # cells per coordinate chunk
+        self.dtype = dtype                      # float32 halves memory use
+        self.values = zeros(self.N.prod(), self.dtype)            # placeholder
 
     # def Button_click(self, entry_start, entry_end, entry_N, entry_aniso, entry_slope):  # NOQA
     #     self.start = array([
@@ -243,51 +242,178 @@ class Grid:
     #     output_file.writelines(['slope', '\t', str(self.slope[0]), '\t', str(self.slope[1]), '\n'])  # NOQA
     #     output_file.close()
 
+    def SubGrid(self, lo, hi):
+        """ return a new Grid covering the cell index box lo:hi (each a
+        length-3 sequence) with the same spacing, anisotropy and slope
+
+        >>> sub = Grid().SubGrid([10, 0, 0], [20, 5, 1])
+        >>> sub.start.tolist(), sub.N.tolist(), sub.xg[0].item()
+        ([10.0, 0.0, 0.0], [10, 5, 1], 10.5)
+        """
+        lo = array(lo, int)
+        hi = array(hi, int)
+        sub = Grid.__new__(Grid)
+        sub.__dict__.update(self.__dict__)
+        sub.start = self.start + lo*self.dl
+        sub.end = self.start + hi*self.dl
+        sub.N = hi - lo
+        sub.xg = self.xg[lo[0]:hi[0]]
+        sub.yg = self.yg[lo[1]:hi[1]]
+        sub.zg = self.zg[lo[2]:hi[2]]
+        sub.values = zeros(sub.N.prod(), self.dtype)
+        return sub
+
     def ApplySlope(self):
         """ alter grid by applying slope vector to z-values
         (done post-interpolation to avoid problems with anisotropy, etc.)
+        the slope is applied as an offset when coordinates are computed
+        """
+        self.sloped = True
+
+    def Coords(self, start=0, stop=None):
+        """ return the (stop - start) x 3 cell-centre coordinates for the
+        flat cell indices start:stop, in the same order as values
+
+        >>> grid = Grid()
+        >>> grid.slope = array([0.5, 0.0])
+        >>> grid.ApplySlope()
+        >>> grid.Coords(100, 102).tolist()
+        [[1.5, 0.5, 1.25], [1.5, 1.5, 1.25]]
+        """
+        n = int(self.N.prod())
+        stop = n if stop is None else int(minimum(stop, n))
+        i, j, k = unravel_index(arange(start, stop), self.N)
+        coords = empty((stop - start, 3), float)
+        coords[:, 0] = self.xg[i]
+        coords[:, 1] = self.yg[j]
+        coords[:, 2] = self.zg[k]
+        if self.sloped:
+            coords[:, 2] += (coords[:, 0] - self.start[0])*self.slope[0] + (coords[:, 1] - self.start[1])*self.slope[1]  # NOQA
+        return coords
+
+    def Chunks(self):
+        # yield (start, stop) flat cell index ranges of at most self.chunk
+        n = int(self.N.prod())
+        for start in range(0, n, self.chunk):
+            yield start, int(minimum(start + self.chunk, n))
+
+    @property
+    def grid(self):
+        # materialized N x 3 coordinate array (prefer CoordRows for big grids)
+        return self.Coords()
+
+    def CoordRows(self):
+        """ the N x 3 cell-centre coordinates as LazyRows, for writing
+        grid-sized output a chunk at a time """
+        return LazyRows(int(self.N.prod()), self.Coords, float)
+
+    def NodeIndices(self, start=0, stop=None):
+        """ MODFLOW (layer, row, column) indices of the flat cells
+        start:stop; layers and rows count down from the top and back
+
+        >>> Grid().NodeIndices(0, 2).tolist()
+        [[1, 100, 1], [1, 99, 1]]
+        """
+        n = int(self.N.prod())
+        stop = n if stop is None else int(minimum(stop, n))
+        i, j, k = unravel_index(arange(start, stop), self.N)
+        return array([self.N[2] - k, self.N[1] - j, i + 1]).T
+
+    @property
+    def X(self):
+        return self.Coords()[:, 0].reshape(self.N)
+
+    @property
+    def Y(self):
+        return self.Coords()[:, 1].reshape(self.N)
+
+    @property
+    def Z(self):
+        return self.Coords()[:, 2].reshape(self.N)
+
+    def InterpGrid(self, pts, v, method='nearest', k=8, exp_gen=2.0,
+                   epsilon=1.0, workers=-1, values_file=None, progress=False):
+        """ interpolate field values at grid points, one chunk at a time,
+        from a single KD-tree over the tensor-scaled points
+        method is 'nearest', or 'idw' to weight the k nearest points as
+        InvDistBatch does; workers is passed to cKDTree.query (-1 uses
+        all cores); values_file, if given, holds values as a .npy memmap
         """
-        self.Z += (self.X - self.start[0])*self.slope[0] + (self.Y - self.start[1])*self.slope[1]  # NOQA
-        self.grid = array([
-            self.X.flatten(),
-            self.Y.flatten(),
-            self.Z.flatten()]).T
-
-    def InterpGrid(self, pts, v):
-        # interpolate field values at grid points
-        self.values = griddata(
-            pts*self.tensor,
-            v, self.grid*self.tensor,
-            method='nearest', fill_value=nan)
-
-    def Nodes(self, log_flag):
-        # create MODFLOW import-ready grid files ...
-        ig = arange(1, self.N[0]+1, 1)        # column index
-        jg = arange(self.N[1], 0, -1)         # row index
-        kg = arange(self.N[2], 0, -1)         # layer index
-        I, J, K = meshgrid(ig, jg, kg, indexing='ij',)
-        node_grid = array([K.flatten(), J.flatten(), I.flatten()]).T
-        # note that 'z' is at the cell center-point
-        z_bottom = self.Z.flatten() - 0.5*self.dl[2]
-        z_top = self.Z.flatten() + 0.5*self.dl[2]
+        tree = cKDTree(pts*self.tensor)
+        n = int(self.N.prod())
+        if values_file is None:
+            self.values = empty(n, self.dtype)
+        else:
+            self.values = lib.format.open_memmap(
+                values_file, mode='w+', dtype=self.dtype, shape=(n,))
+        k = int(minimum(k, len(pts)))
+        for start, stop in self.Chunks():
+            coords = self.Coords(start, stop)
+            if method == 'nearest':
+                _, idx = tree.query(coords*self.tensor, workers=workers)
+                self.values[start:stop] = v[idx]
+            elif method == 'idw':
+                _, idx = tree.query(coords*self.tensor, k=k, workers=workers)  # NOQA
+                indptr = arange(0, idx.size + 1, k)
+                self.values[start:stop] = InvDistBatch(
+                    coords, pts, v, self.tensor, exp_gen, epsilon,
+                    indptr, idx.ravel())
+            else:
+                raise ValueError('unknown gridding method: ' + str(method))
+            if progress:
+                print('\t... gridded {} of {} cells.'.format(stop, n))
+
+    def Nodes(self, log_flag, fmt='.txt'):
+        # create MODFLOW import-ready grid files (fmt: see OUTPUT_FORMATS);
+        # node indices and cell tops and bottoms are computed per chunk
+        n = int(self.N.prod())
+        node_grid = LazyRows(n, self.NodeIndices, int)
+
+        def z_face(offset):
+            # note that 'z' is at the cell center-point
+            return LazyRows(n, lambda s, e: (
+                self.Coords(s, e)[:, 2] + offset).astype(self.dtype),
+                self.dtype)
+        names = ('layer', 'row', 'column', 'value')
         if log_flag:
-            WriteOutput(node_grid, 10.**self.values, 'val_mf.txt', 0)
+            values = LazyRows(n, lambda s, e: 10.**self.values[s:e],
+                              self.values.dtype)
+            WriteOutput(node_grid, values, 'val_mf' + fmt, 0, names)
         else:
-            WriteOutput(node_grid, self.values, 'val_mf.txt', 0)
-        WriteOutput(node_grid, z_bottom, 'zbottom_mf.txt', 0)
-        WriteOutput(node_grid, z_top, 'ztop_mf.txt', 0)
+            WriteOutput(node_grid, self.values, 'val_mf' + fmt, 0, names)
+        WriteOutput(node_grid, z_face(-0.5*self.dl[2]), 'zbottom_mf' + fmt, 0, names)  # NOQA
+        WriteOutput(node_grid, z_face(0.5*self.dl[2]), 'ztop_mf' + fmt, 0, names)  # NOQA
 
     def Stretch(self, sigma_new, min_value, max_value):
-        # stretch or compress normal distribution of field values
-        nu = self.values.mean()
+        """ stretch or compress normal distribution of field values,
+        in place and one chunk at a time
+
+        >>> grid = Grid()
+        >>> grid.values = random.RandomState(0).normal(0.0, 0.5, 10000)
+        >>> grid.chunk = 999
+        >>> grid.Stretch(1.0, -3.0, 1.5)
+        >>> print(round(grid.values.max(), 6), round(grid.values.std(), 2))
+        1.5 0.94
+        """
+        n = len(self.values)
+        nu = 0.0
+        for start, stop in self.Chunks():
+            nu += self.values[start:stop].sum(dtype=float64)
+        nu /= n
         # grid (initial) standard deviation (typically smaller/tighter)
-        sigma_0 = self.values.std()
-        # match grid values to corresponding cumulative distributions points
-        cum_dist = norm.cdf(self.values, nu, sigma_0)
-        # map cumulative distribution points to new grid values
-        grid_raw = norm.ppf(cum_dist, nu, sigma_new)
-        grid_bottom = where(grid_raw >= min_value, grid_raw, min_value)
-        self.values = where(grid_bottom <= max_value, grid_bottom, max_value)
+        ss = 0.0
+        for start, stop in self.Chunks():
+            ss += ((self.values[start:stop] - nu)**2).sum(dtype=float64)
+        sigma_0 = sqrt(ss/n)
+        for start, stop in self.Chunks():
+            chunk = self.values[start:stop]
+            if sigma_0 > 0:
+                # norm.ppf(norm.cdf(x, nu, sigma_0), nu, sigma_new) is the
+                # affine map below, without the tail saturation of the cdf
+                chunk -= nu
+                chunk *= sigma_new/sigma_0
+                chunk += nu
+            clip(chunk, min_value, max_value, out=chunk)
 
     def PlotSlice(self):
         # for 2-D realizations, generate color-map plot ...
@@ -311,6 +437,72 @@ class Grid:
             Contour(array(self.xg), array(self.yg), b.T, x_label, y_label)
 
 
+class PointStore:
+    """ growable, preallocated store of point locations and values with a
+    uniform hash-grid neighbour index; cells are cubes of side cell_size
+    (typically r_search), so a radius search only visits nearby cells and
+    every appended point is immediately searchable
+
+    >>> store = PointStore(array([[0.0, 0.0, 0.0]]), array([1.0]), 10.0, 2)
+    >>> store.Append(array([5.0, 0.0, 0.0]), 2.0)
+    >>> store.Append(array([50.0, 0.0, 0.0]), 3.0)
+    >>> store.n, len(store.pts), store.v.tolist()
+    (3, 3, [1.0, 2.0, 3.0])
+    >>> sorted(store.QueryBall(array([4.0, 0.0, 0.0]), 10.0).tolist())
+    [0, 1]
+    """
+    def __init__(self, pts, v, cell_size, capacity=0):
+        capacity = int(max([capacity, len(pts), 1]))
+        self.cell_size = float(cell_size)
+        self._pts = empty((capacity, 3), float)
+        self._v = empty(capacity, float)
+        self._cells = {}
+        self.n = 0
+        for i in range(len(pts)):
+            self.Append(pts[i], v[i])
+
+    @property
+    def pts(self):
+        return self._pts[:self.n]
+
+    @property
+    def v(self):
+        return self._v[:self.n]
+
+    def _Key(self, p):
+        return tuple(floor(p/self.cell_size).astype(int))
+
+    def Append(self, p, value):
+        # add a point, doubling the preallocated arrays when full
+        if self.n == len(self._v):
+            self._pts = concatenate((self._pts, empty_like(self._pts)))
+            self._v = concatenate((self._v, empty_like(self._v)))
+        self._pts[self.n] = p
+        self._v[self.n] = value
+        # each cell holds a growable index array and its fill count
+        cell = self._cells.setdefault(self._Key(p), [empty(8, intp), 0])
+        if cell[1] == len(cell[0]):
+            cell[0] = concatenate((cell[0], empty_like(cell[0])))
+        cell[0][cell[1]] = self.n
+        cell[1] += 1
+        self.n += 1
+
+    def QueryBall(self, p, r):
+        # return indices of all stored points within distance r of p
+        span = int(ceil(r/self.cell_size))
+        lo = floor(p/self.cell_size).astype(int) - span
+        candidates = [zeros(0, intp)]
+        for i in range(lo[0], lo[0] + 2*span + 1):
+            for j in range(lo[1], lo[1] + 2*span + 1):
+                for k in range(lo[2], lo[2] + 2*span + 1):
+                    cell = self._cells.get((i, j, k))
+                    if cell is not None:
+                        candidates.append(cell[0][:cell[1]])
+        candidates = concatenate(candidates)
+        d2 = ((self._pts[candidates] - p)**2).sum(axis=1)
+        return candidates[d2 <= r**2]
+
+
 #########################################
 #
 # support functions
@@ -318,28 +510,155 @@ class Grid:
 #########################################
 
 
+class LazyRows:
+    """ an n-row array whose rows are computed by rows(start, stop) when
+    they are sliced; the output writers only slice blocks of rows (and
+    [rows, column]), so grid-sized output is never materialized
+
+    >>> rows = LazyRows(5, lambda s, e: arange(s, e).reshape(-1, 1)*[1, 10], int)  # NOQA
+    >>> len(rows), rows[3:10].tolist(), rows[1:3, 1].tolist()
+    (5, [[3, 30], [4, 40]], [10, 20])
+    """
+    def __init__(self, n, rows, dtype):
+        self.n = n
+        self.rows = rows
+        self.dtype = array([], dtype).dtype
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        start, stop, step = key.indices(self.n)
+        block = asarray(self.rows(start, stop), self.dtype)[::step]
+        return block[(slice(None),) + rest]
+
+
 def NormVector(x, y, z):
     tot = abs(x)+abs(y)+abs(z)
     return array([x/tot, y/tot, z/tot]).T
 
 
-def WriteOutput(points, values, file_name, header_flag=1):
-    output_file = open(file_name, 'w')
-    if header_flag:
-        line_out = ['x', '\t', 'y', '\t', 'z', '\t', 'value', '\n']
-        output_file.writelines(line_out)
-    for i in range(len(values)):
-        line_out = []
-        line_out.append(str(points[i, 0]))
-        line_out.append('\t')
-        line_out.append(str(points[i, 1]))
-        line_out.append('\t')
-        line_out.append(str(points[i, 2]))
-        line_out.append('\t')
-        line_out.append(str(values[i]))
-        line_out.append('\n')
-        output_file.writelines(line_out)
-    output_file.close()
+def WriteOutput(points, values, file_name, header_flag=1,
+                names=('x', 'y', 'z', 'value'), fmt=None):
+    """ write an M x 3 point array and M values to file_name; the format
+    follows the file extension unless fmt is given (one of the keys of
+    OUTPUT_FORMATS, anything else is a ValueError): '.txt' is the
+    tab-separated text layout, '.npy' a memory-mapped structured array
+    and '.npz' compressed columns. points and values may be LazyRows
+    (e.g. Grid.CoordRows()), which every writer reads a chunk of rows at
+    a time
+
+    >>> import os, tempfile
+    >>> file_name = os.path.join(tempfile.mkdtemp(), 'out.txt')
+    >>> WriteOutput(array([[1, 2, 3], [4, 5, 6]]), array([0.1, nan]), file_name)  # NOQA
+    >>> open(file_name).read()
+    'x\\ty\\tz\\tvalue\\n1\\t2\\t3\\t0.1\\n4\\t5\\t6\\tnan\\n'
+    >>> WriteOutput(array([[0.5, 1e-05, 1e+16]]), array([1], float32), file_name, 0)  # NOQA
+    >>> open(file_name).read()
+    '0.5\\t1e-05\\t1e+16\\t1.0\\n'
+    >>> WriteOutput(array([[0, 0, 0]]), array([1.0]), 'out.dat')
+    Traceback (most recent call last):
+    ...
+    ValueError: unknown output format: '.dat'
+    """
+    if fmt is None:
+        fmt = os.path.splitext(file_name)[1]
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError('unknown output format: {!r}'.format(fmt))
+    OUTPUT_FORMATS[fmt](points, values, file_name, header_flag, names)
+
+
+def FormatColumn(a):
+    """ format a 1-D array exactly as str() formats each of its elements """
+    a = asarray(a)
+    if a.dtype.kind in 'iub' or a.dtype == float64:
+        # python ints and floats print identically to their numpy scalars
+        return list(map(str, a.tolist()))
+    return a.astype(str).tolist()
+
+
+def WriteText(points, values, file_name, header_flag=1,
+              names=('x', 'y', 'z', 'value'), chunk=100000):
+    # tab-separated text, formatted a chunk of rows at a time
+    with open(file_name, 'w') as output_file:
+        if header_flag:
+            output_file.write('\t'.join(names) + '\n')
+        for s in range(0, len(values), chunk):
+            # one read of the chunk's rows (LazyRows compute them)
+            block = points[s:s+chunk]
+            cols = [FormatColumn(block[:, i]) for i in range(3)]
+            cols.append(FormatColumn(values[s:s+chunk]))
+            output_file.write(''.join(['\t'.join(row) + '\n' for row in zip(*cols)]))  # NOQA
+
+
+def WriteNpy(points, values, file_name, header_flag=1,
+             names=('x', 'y', 'z', 'value'), chunk=1000000):
+    # structured .npy array (one field per column), filled through a memmap
+    if not isinstance(values, LazyRows):
+        values = asarray(values)
+    dt = [(names[i], points.dtype) for i in range(3)]
+    dt.append((names[3], values.dtype))
+    out = lib.format.open_memmap(
+        file_name, mode='w+', dtype=dt, shape=(len(values),))
+    for s in range(0, len(values), chunk):
+        block = points[s:s+chunk]
+        for i in range(3):
+            out[names[i]][s:s+chunk] = block[:, i]
+        out[names[3]][s:s+chunk] = values[s:s+chunk]
+    out.flush()
+    del out
+
+
+def WriteNpz(points, values, file_name, header_flag=1,
+             names=('x', 'y', 'z', 'value'), chunk=1000000):
+    # compressed, one named array per column, as savez_compressed writes
+    # them but streamed into the archive a chunk of rows at a time
+    if not isinstance(values, LazyRows):
+        values = asarray(values)
+    if not file_name.endswith('.npz'):
+        file_name += '.npz'
+    n = len(values)
+    spill = None
+    if isinstance(points, LazyRows):
+        # the archive takes one column at a time, so compute each chunk
+        # of coordinates once into a temporary file and read it back
+        spill = file_name + '.tmp.npy'
+        rows = lib.format.open_memmap(
+            spill, mode='w+', dtype=points.dtype, shape=(n, 3))
+        for s in range(0, n, chunk):
+            rows[s:s+chunk] = points[s:s+chunk]
+        points = rows
+    try:
+        _WriteNpzColumns(points, values, file_name, names, chunk)
+    finally:
+        if spill is not None:
+            del points, rows
+            os.remove(spill)
+
+
+def _WriteNpzColumns(points, values, file_name, names, chunk):
+    n = len(values)
+    with zipfile.ZipFile(file_name, 'w', zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as archive:
+        for i, name in enumerate(names):
+            source = values if i == 3 else points
+            with archive.open(name + '.npy', 'w', force_zip64=True) as f:
+                lib.format.write_array_header_1_0(f, {
+                    'descr': lib.format.dtype_to_descr(source.dtype),
+                    'fortran_order': False, 'shape': (n,)})
+                for s in range(0, n, chunk):
+                    block = source[s:s+chunk] if i == 3 else source[s:s+chunk, i]  # NOQA
+                    f.write(ascontiguousarray(block, source.dtype).tobytes())
+
+
+OUTPUT_FORMATS = {
+    '.txt': WriteText,
+    '.npy': WriteNpy,
+    '.npz': WriteNpz,
+}
 
 
 def InvDistSquared(p, pts, v_pts, tensor, k, epsilon):
@@ -353,16 +672,86 @@ def InvDistSquared(p, pts, v_pts, tensor, k, epsilon):
     # find the distance distoration factor from the anisotropy tensor
     f = sqrt(1.0/sum(nv**2/tensor**2, axis=1))
     mapfunc = partial(distance.euclidean, v=p)
-    d = map(mapfunc, pts)
+    d = list(map(mapfunc, pts))
     h = sqrt((f*array(d))**2. + (f*epsilon)**2.)
     a = sum(v_pts/h**k)
     b = sum(1.0/h**k)
     return a/b
 
 
-def ReadSeeds(params, grid):
-    # read in initial point set (used as seeds)
-    input_file = open('seeds.txt', 'r')
+def InvDistBatch(P, pts, v_pts, tensor, k, epsilon, indptr=None, indices=None):
+    """ interpolate field values at many query points P(x,y,z) in one pass,
+    using the same anisotropic inverse-distance weighting as InvDistSquared
+    P is a Q x 3 numpy array; pts is M x 3 and v_pts is length M;
+    neighbour sets are given in CSR form (indices[indptr[i]:indptr[i+1]]
+    index the rows of pts used for query i); if indptr is None, every
+    query point is weighted against all of pts
+    queries with no neighbours return nan
+
+    >>> from scipy.spatial import cKDTree
+    >>> rs = random.RandomState(1)
+    >>> pts = rs.uniform(0.0, 100.0, (500, 3))
+    >>> v_pts = rs.uniform(-3.0, 1.5, 500)
+    >>> P = rs.uniform(0.0, 100.0, (50, 3))
+    >>> tensor = 1.0/array([1.0, 0.2, 1.0])
+    >>> near = cKDTree(pts).query_ball_point(P, 25.0)
+    >>> indptr, indices = CsrNeighbours(near)
+    >>> batch = InvDistBatch(P, pts, v_pts, tensor, 2.0, 1.0, indptr, indices)
+    >>> loop = [InvDistSquared(P[i], pts[near[i]], v_pts[near[i]], tensor, 2.0, 1.0)  # NOQA
+    ...         for i in range(len(P))]
+    >>> print(allclose(batch, loop, rtol=1e-12, atol=0.0))
+    True
+    >>> dense = InvDistBatch(P[:3], pts, v_pts, tensor, 2.0, 1.0)
+    >>> loop = [InvDistSquared(p, pts, v_pts, tensor, 2.0, 1.0) for p in P[:3]]  # NOQA
+    >>> print(allclose(dense, loop, rtol=1e-12, atol=0.0))
+    True
+    """
+    P = atleast_2d(P)
+    if indptr is None:
+        # every query point sees the full point set
+        q = repeat(arange(len(P)), len(pts))
+        dp = (P[:, newaxis, :] - pts[newaxis, :, :]).reshape(-1, 3)
+        vj = tile(v_pts, len(P))
+    else:
+        q = repeat(arange(len(P)), diff(indptr))
+        j = asarray(indices, dtype=intp)
+        dp = P[q] - pts[j]
+        vj = v_pts[j]
+    dx, dy, dz = dp.T
+    # normalize the point direction with reference to axes
+    tot = abs(dx) + abs(dy) + abs(dz)
+    # find the distance distortion factor from the anisotropy tensor
+    f = sqrt(1.0/(
+        (dx/tot)**2/tensor[0]**2 +
+        (dy/tot)**2/tensor[1]**2 +
+        (dz/tot)**2/tensor[2]**2))
+    d = sqrt(dx**2 + dy**2 + dz**2)
+    h = sqrt((f*d)**2. + (f*epsilon)**2.)
+    w = 1.0/h**k
+    a = bincount(q, weights=vj*w, minlength=len(P))
+    b = bincount(q, weights=w, minlength=len(P))
+    with errstate(invalid='ignore', divide='ignore'):
+        return a/b
+
+
+def CsrNeighbours(near):
+    """ pack a sequence of neighbour index lists (e.g. from
+    query_ball_point) into CSR (indptr, indices) arrays for InvDistBatch
+    """
+    counts = array([len(n) for n in near], dtype=intp)
+    indptr = zeros(len(near) + 1, dtype=intp)
+    cumsum(counts, out=indptr[1:])
+    if indptr[-1]:
+        indices = concatenate([asarray(n, dtype=intp) for n in near])
+    else:
+        indices = zeros(0, dtype=intp)
+    return indptr, indices
+
+
+def ReadSeeds(params, grid, rng=random, seed_file='seeds.txt'):
+    # read in initial point set (used as seeds); rng may be numpy.random
+    # or a numpy.random.Generator for reproducible, independent streams
+    input_file = open(seed_file, 'r')
     pts = []
     values = []
     i = 0
@@ -378,16 +767,133 @@ def ReadSeeds(params, grid):
         i += 1
     # add additional seed points
     for i in range(params.num_extra_seeds):
-        x = random.uniform(grid.start[0], grid.end[0])
-        y = random.uniform(grid.start[1], grid.end[1])
-        z = random.uniform(grid.start[2], grid.end[2])
-        v = random.uniform(params.min_value, params.max_value)
+        x = rng.uniform(grid.start[0], grid.end[0])
+        y = rng.uniform(grid.start[1], grid.end[1])
+        z = rng.uniform(grid.start[2], grid.end[2])
+        v = rng.uniform(params.min_value, params.max_value)
         pts.append([x, y, z])
         values.append(v)
     input_file.close()
     return array(pts), array(values)
 
 
+def Spawn(params, grid, pts, v, rng=random):
+    """ populate the point set by sequential addition of points around
+    the seeds pts, v until params.max_pts points exist
+    """
+    store = PointStore(pts, v, params.r_search, params.max_pts)
+
+    while store.n < params.max_pts:
+
+        # generate new point location
+        xp = rng.uniform(grid.start[0], grid.end[0])
+        yp = rng.uniform(grid.start[1], grid.end[1])
+        zp = rng.uniform(grid.start[2], grid.end[2])
+        p = array([xp, yp, zp])
+
+        # search for points within r_search
+        near_point_set = store.QueryBall(p, params.r_search)
+
+        # extract those points falling within the search radius into a collapse matrix   # NOQA
+        near_pts = store.pts[near_point_set]
+        near_vals = store.v[near_point_set]
+
+        # assign a value associated with the new (x,y,z) location
+        if len(near_pts) == 0:
+            # assign random value from a uniform distribution
+            p_value = rng.uniform(params.min_value, params.max_value)
+        else:
+            # create a virtual random point on boundary of cylindrical search
+            # zone of radius ref_dist, assign random value to it, and then
+            # process along with rest of data set
+            theta = rng.uniform(0.0, 2*pi)
+            dxp = params.ref_dist * cos(theta)
+            dyp = params.ref_dist * sin(theta)
+            zp = rng.uniform(grid.start[2], grid.end[2])
+            vp = array([xp+dxp, yp+dyp, zp])
+            # random value for point (some influence from other points,
+            # so glaring outlier less likely)
+            r_value = rng.uniform(params.min_value, params.max_value)
+            near_pts_v = concatenate((near_pts, [vp]), axis=0)
+            near_vals_v = concatenate((near_vals, [r_value]))
+            p_value = InvDistBatch(
+                p, near_pts_v, near_vals_v,
+                grid.tensor, params.exp_gen, params.epsilon)[0]
+
+        # add new point to location and value arrays
+        store.Append(p, p_value)
+
+    return store.pts, store.v
+
+
+def SequentialField(params, grid, rng=random, seed_file='seeds.txt',
+                    domain_fraction=1.0, **options):
+    """ field engine: sequential addition of points around the seeds,
+    gridded by nearest neighbour (high fidelity, serial); returns grid
+    when grid is a part (e.g. a tile) of a larger domain, domain_fraction
+    is its share of the cells, and the point budget is scaled by it to
+    keep the spawned point density of the full domain
+    """
+    if domain_fraction != 1.0:
+        params = shallow_copy(params)
+        params.max_pts = int(ceil(params.max_pts*domain_fraction))
+        params.num_extra_seeds = int(ceil(params.num_extra_seeds*domain_fraction))  # NOQA
+    pts, v = ReadSeeds(params, grid, rng=rng, seed_file=seed_file)
+    pts, v = Spawn(params, grid, pts, v, rng=rng)
+    grid.InterpGrid(pts, v)
+    return grid
+
+
+def SpectralField(params, grid, rng=random, corr_len=None, **options):
+    """ field engine: Gaussian-correlated field synthesized directly on the
+    grid by FFT filtering of white noise, O(N log N); returns grid
+    the correlation length (default params.r_search) is scaled per axis
+    by grid.aniso; values are centred on the [min_value, max_value]
+    range with the spread of a uniform draw from it (in expectation;
+    each realization keeps its own sample mean and spread), then clipped
+    as in Grid.Stretch; seed points are not honoured
+
+    >>> grid = SpectralField(Params(), Grid(), random.default_rng(0))
+    >>> grid.values.shape
+    (10000,)
+    >>> print(grid.values.min() >= -3.0, grid.values.max() <= 1.5)
+    True True
+    """
+    L = (params.r_search if corr_len is None else corr_len)*grid.aniso
+    # pad the domain so the periodic FFT does not wrap correlation around
+    pad = where(grid.N > 1, ceil(2.0*L/grid.dl), 0).astype(int)
+    M = tuple(int(m) for m in grid.N + pad)
+    # Gaussian covariance exp(-(h/L)**2) <-> spectrum exp(-(k*L)**2/4)
+    kx = 2*pi*fft.fftfreq(M[0], grid.dl[0])[:, newaxis, newaxis]
+    ky = 2*pi*fft.fftfreq(M[1], grid.dl[1])[newaxis, :, newaxis]
+    kz = 2*pi*fft.rfftfreq(M[2], grid.dl[2])[newaxis, newaxis, :]
+    amplitude = exp(-((kx*L[0])**2 + (ky*L[1])**2 + (kz*L[2])**2)/8.0)
+    noise = rng.standard_normal(M)
+    field = fft.irfftn(fft.rfftn(noise)*amplitude, s=M, axes=(0, 1, 2))
+    field = field[:grid.N[0], :grid.N[1], :grid.N[2]].ravel()
+    # the filtered noise has mean 0 and the variance of the filter kernel
+    # at every cell; normalizing by those rather than by the sample mean
+    # and std keeps the field stationary, so independently generated
+    # tiles have the same statistics everywhere (see tiling.stitch)
+    kernel = fft.irfftn(amplitude, s=M, axes=(0, 1, 2))
+    sigma = sqrt((kernel**2).sum())
+    if sigma > 0:
+        field /= sigma
+    mid = 0.5*(params.min_value + params.max_value)
+    spread = (params.max_value - params.min_value)/sqrt(12.0)
+    grid.values = clip(mid + spread*field, params.min_value, params.max_value).astype(grid.dtype)  # NOQA
+    return grid
+
+
+# every engine is called as engine(params, grid, rng=rng, **options) and
+# fills grid.values; options an engine does not use (seed_file,
+# domain_fraction, ...) are ignored
+FIELD_ENGINES = {
+    'sequential': SequentialField,
+    'spectral': SpectralField,
+}
+
+
 def Contour(U, V, M, x_label, y_label):
     # contour distribution, depending on geometry
     plt.pcolor(U, V, M, cmap=cm.RdBu)
@@ -452,10 +958,10 @@ def Bin(A, n):
     return digitize(A, bins)
 
 
-def ManageGroups(grid, n):
+def ManageGroups(grid, n, fmt='.txt'):
     # instructions for button in CreateGroups window
     group_indices = Bin(grid.values, n)
-    WriteOutput(grid.grid, group_indices, 'group_distrib.txt')
+    WriteOutput(grid.CoordRows(), group_indices, 'group_distrib' + fmt)
 
 
 def CreateGroups(grid):
@@ -498,52 +1004,11 @@ def Points():
 
     # read seed points, if used
     pts, v = ReadSeeds(params, grid)
-    tree = KDTree(pts)  
     print('Read and supplemented seed points.')
 
     # populate point set by bootstrapping
     print('Spawning points ...')
-
-    while len(pts) < params.max_pts:
-
-        # generate new point location
-        xp = random.uniform(grid.start[0], grid.end[0])
-        yp = random.uniform(grid.start[1], grid.end[1])
-        zp = random.uniform(grid.start[2], grid.end[2])
-        p = array([xp, yp, zp])
-
-        # search for points within r_search
-        near_point_set = list(tree.query_ball_point(p, params.r_search))
-
-        # extract those points falling within the search radius into a collapse matrix   # NOQA
-        near_pts = pts[near_point_set]
-        near_vals = v[near_point_set]
-
-        # assign a value associated with the new (x,y,z) location
-        if len(near_pts) == 0:
-            # assign random value from a uniform distribution
-            p_value = random.uniform(params.min_value, params.max_value)
-        else:
-            # create a virtual random point on boundary of cylindrical search
-            # zone of radius ref_dist, assign random value to it, and then
-            # process along with rest of data set
-            theta = random.uniform(0.0, 2*pi)
-            dxp = params.ref_dist * cos(theta)
-            dyp = params.ref_dist * sin(theta)
-            zp = random.uniform(grid.start[2], grid.end[2])
-            vp = array([xp+dxp, yp+dyp, zp])
-            # random value for point (some influence from other points,
-            # so glaring outlier less likely)
-            r_value = random.uniform(params.min_value, params.max_value)
-            near_pts_v = concatenate((near_pts, [vp]), axis=0)
-            near_vals_v = concatenate((near_vals, [r_value]))
-            p_value = InvDistSquared(
-                p, near_pts_v, near_vals_v,
-                grid.tensor, params.exp_gen, params.epsilon)
-
-        # add new point to location and value arrays
-        pts = concatenate((pts, [p]), axis=0)
-        v = concatenate((v, [p_value]))
+    pts, v = Spawn(params, grid, pts, v)
 
     # write point set to output file
     WriteOutput(pts, v, 'point_set.txt')
@@ -551,7 +1016,7 @@ def Points():
 
     # interpolate point set across grid
     print('Gridding ...')
-    grid.InterpGrid(pts, v)
+    grid.InterpGrid(pts, v, progress=True)
 
     # summarize set statistics and stretch grid histogram, if requested
     # grid = SetStats(v, grid, params)
@@ -559,7 +1024,7 @@ def Points():
     # process output
     # alter z-values, post-interpolation, to account for slope
     grid.ApplySlope()
-    WriteOutput(grid.grid, grid.values, 'grid_out.txt')   # values output
+    WriteOutput(grid.CoordRows(), grid.values, 'grid_out.txt')  # values output
     # create property group distributions output, if indicated
     CreateGroups(grid)
     # check if special output (e.g., MODFLOW input) files are to be written
@@ -576,3 +1041,7 @@ def Points():
 ########################################################
 
 # Points()
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,143 @@
+# Streaming canopy-height (CHM) and terrain (DTM) rasters from point chunks
+import numpy as np
+
+from voxel import aggregate, cell_index
+
+
+class HeightRaster():
+    """ A max (or min) Z raster over the box lo-hi, accumulated one chunk
+    at a time into a memory-mapped .npy file.
+
+    Rows run from high to low Y (row 0 is the top edge), as world files
+    expect; cells without points are nan. Each chunk is reduced per cell
+    with a single sort before it touches the file, so only the chunk and
+    the cells it covers are ever in memory.
+
+    >>> import os, tempfile
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'chm.npy')
+    >>> chm = HeightRaster(filename, [0, 0], [1.9, 0.9], resolution=1.0)
+    >>> chm.add(np.array([0.5, 0.5, 1.5]), np.array([0.5, 0.5, 0.5]), np.array([1.0, 3.0, 2.0]))  # NOQA
+    >>> chm.add(np.array([1.5, 9.0]), np.array([0.2, 9.0]), np.array([5.0, 9.0]))  # NOQA
+    >>> chm.values.tolist()
+    [[3.0, 5.0]]
+    >>> chm.world_file(filename[:-4] + '.wld')
+    [1.0, 0.0, 0.0, -1.0, 0.5, 0.5]
+    """
+    def __init__(self, filename, lo, hi, resolution=0.2, reducer='max',
+                 dtype=np.float32):
+        self.filename = filename
+        self.resolution = resolution
+        self.reducer = reducer
+        self.origin = cell_index(np.asarray(lo, dtype=float), resolution)
+        end = cell_index(np.asarray(hi, dtype=float), resolution) + 1
+        self.shape = (int(end[1] - self.origin[1]),
+                      int(end[0] - self.origin[0]))
+        self.values = np.lib.format.open_memmap(
+            filename, mode='w+', dtype=dtype, shape=self.shape)
+        self.values[:] = np.nan
+        self._combine = np.fmax if reducer == 'max' else np.fmin
+
+    def add(self, x, y, z):
+        col = cell_index(x, self.resolution) - self.origin[0]
+        row = self.shape[0] - 1 - (
+            cell_index(y, self.resolution) - self.origin[1])
+        keep = (
+            (col >= 0) & (col < self.shape[1]) &
+            (row >= 0) & (row < self.shape[0]))
+        if not keep.any():
+            return
+        cells = aggregate(
+            row[keep]*self.shape[1] + col[keep], z[keep], (self.reducer,))
+        flat = self.values.reshape(-1)
+        flat[cells['keys']] = self._combine(
+            flat[cells['keys']], cells[self.reducer])
+
+    def world_file(self, filename, transform=None):
+        """ Write an ESRI world file for the raster and return its six
+        terms.
+
+        transform is the affine matrix (e.g. PDAL.transformation_matrix)
+        that took the points into the raster's frame; its inverse is
+        folded into the world file, so a raster on a plot's rotated grid
+        is placed back in map coordinates.
+        """
+        d = self.resolution
+        # frame coordinates of the upper-left cell centre and of one step
+        # along a row and down a column
+        top = (self.origin[1] + self.shape[0])*d
+        corner = np.array([(self.origin[0] + 0.5)*d, top - 0.5*d])
+        steps = np.array([[d, 0.0], [0.0, -d]])
+        if transform is not None:
+            M = np.asarray(transform, dtype=float)
+            inverse = np.linalg.inv(M[np.ix_([0, 1, 3], [0, 1, 3])])
+            corner = inverse[:2, :2].dot(corner) + inverse[:2, 2]
+            steps = steps.dot(inverse[:2, :2].T)
+        # A, D, B, E, C, F
+        terms = [float(t) for t in (
+            steps[0, 0], steps[0, 1], steps[1, 0], steps[1, 1],
+            corner[0], corner[1])]
+        with open(filename, 'w') as f:
+            for t in terms:
+                print(repr(t), file=f)
+        return terms
+
+    def flush(self):
+        self.values.flush()
+
+
+def chm_dtm(prefix, lo, hi, resolution=0.2):
+    """ The <prefix>_chm.npy (max Z) and <prefix>_dtm.npy (min Z)
+    HeightRasters over the box lo-hi """
+    return (HeightRaster(prefix + '_chm.npy', lo, hi, resolution, 'max'),
+            HeightRaster(prefix + '_dtm.npy', lo, hi, resolution, 'min'))
+
+
+def rasterize(chunks, rasters, transform=None):
+    """ Pass a chunk iterator through unchanged while adding every chunk
+    to the rasters; once the chunks run out the rasters are flushed and
+    each gets a .wld world file (see HeightRaster.world_file), so other
+    per-chunk work can share the same pass """
+    for chunk in chunks:
+        for raster in rasters:
+            raster.add(chunk['X'], chunk['Y'], chunk['Z'])
+        yield chunk
+    for raster in rasters:
+        raster.flush()
+        raster.world_file(raster.filename[:-len('.npy')] + '.wld', transform)
+
+
+def height_rasters(chunks, prefix, lo, hi, resolution=0.2, transform=None):
+    """ Write <prefix>_chm.npy (max Z) and <prefix>_dtm.npy (min Z), each
+    with a .wld world file, in one pass over a chunk iterator; points
+    outside the box lo-hi are ignored. Returns the two HeightRasters. """
+    rasters = chm_dtm(prefix, lo, hi, resolution)
+    for _ in rasterize(chunks, rasters, transform):
+        pass
+    return rasters
+
+
+if __name__ == "__main__":
+    import argparse
+    from pointcloud_io import PointCache, read_chunks
+    parser = argparse.ArgumentParser(
+        description='Write max (CHM) and min (DTM) Z rasters of a point '
+                    'cloud as .npy files with world files.')
+    parser.add_argument('cloud', help='cache directory, LAS or xyz/csv')
+    parser.add_argument('prefix')
+    parser.add_argument('-r', '--resolution', type=float, default=0.2)
+    parser.add_argument('--chunk-size', type=int, default=1000000)
+    args = parser.parse_args()
+    try:
+        bounds = PointCache(args.cloud).header['bounds']
+    except (IOError, OSError):
+        # no cache header, so find the bounds with an extra pass
+        bounds = {'X': [np.inf, -np.inf], 'Y': [np.inf, -np.inf]}
+        for chunk in read_chunks(args.cloud, args.chunk_size):
+            for name in ('X', 'Y'):
+                bounds[name] = [min(bounds[name][0], chunk[name].min()),
+                                max(bounds[name][1], chunk[name].max())]
+    lo = [bounds['X'][0], bounds['Y'][0]]
+    hi = [bounds['X'][1], bounds['Y'][1]]
+    height_rasters(read_chunks(args.cloud, args.chunk_size), args.prefix, lo,
+                   hi, args.resolution)
+    print('Wrote {0}_chm.npy and {0}_dtm.npy.'.format(args.prefix))
@@ -1,6 +1,10 @@
 import numpy as np
 import pandas as pd
-import laspy
+
+from pointcloud_io import read_chunks
+from voxel import (
+    VoxelAccumulator, aggregate, cell_index, pack_keys, profile_cube,
+    profile_stats, unpack_keys)
 
 
 def bin_points(points, d):
@@ -8,51 +12,89 @@ def bin_points(points, d):
     return np.floor(points/d)*d
 
 
-def create_profile(x, bins=None):
-    """ Create a profile for a set of points. Requires there to be a Zbin
+def create_profile(chunks, dxy=1., dz=0.25):
+    """ Create vertical profiles for every (Xbin, Ybin) column at once.
 
+    Builds the full (Xbin, Ybin, Zbin) point-count cube in one vectorized
+    pass over a chunk iterator. Returns (counts, origin), where
+    counts[i, j, k] is the number of points in the voxel whose bin labels
+    are (origin + (i, j, k))*(dxy, dxy, dz); see voxel.profile_stats for
+    per-column statistics.
     """
-    counts, bin_edges = np.histogram(x, bins=bins)
-    return mean(counts)
-
-
-# Load the file
-filename = 'uhnb3mes_rotate_scale.las'
-working_dir = '/Users/kellycaylor/Documents/dev/sfm/'
-
-las_file = laspy.file.File(working_dir + filename)
-
-
-XYZ = pd.DataFrame({
-        'X': las_file.X,
-        'Y': las_file.Y,
-        'Z': las_file.Z
-        })
-
-XYZ.X = XYZ.X/100
-XYZ.Y = XYZ.Y/100
-XYZ.Z = XYZ.Z/100
-
-
-#  Here is where we "make" subplots
-
-dxy = 1.  # 2 meter bins in X and Y directions
-dz = 0.25  # 0.5 meter bins in vertical.
-
-XYZ['Xbin'] = bin_points(XYZ.X, dxy)
-XYZ['Ybin'] = bin_points(XYZ.Y, dxy)
-XYZ['Zbin'] = bin_points(XYZ.Z, dz)
-
-counts_by_subplot = XYZ.groupby(['Xbin', 'Ybin', 'Zbin'])['Z'].count()
-
-# Groupby is the magic.
-max_height = XYZ.groupby(['Xbin', 'Ybin'])['Z'].max()
-n_points = XYZ.groupby(['Xbin', 'Ybin'])['Z'].count()
-
-groups = XYZ.groupby(['Xbin', 'Ybin'])['Z', 'Zbin']
-
-
-# Make profiles for each subplot
-z_bins = np.arange(0, np.ceil(np.max(XYZ.Z)), dz) + dz
-profiles = XYZ.groupby(['Xbin', 'Ybin'])['Z'].pipe(create_profile, bins=z_bins)
-
+    return profile_cube(chunks, dxy, dz)
+
+
+def subplot_stats(chunks, dxy=1., dz=0.25):
+    """ Bin a stream of point chunks into subplots.
+
+    chunks is an iterable of structured arrays (or DataFrames) with X, Y
+    and Z, e.g. from pointcloud_io.read_chunks. Points are reduced per
+    (Xbin, Ybin, Zbin) voxel with one sort per chunk and the partial
+    results are merged, so the whole cloud is never held in memory; the
+    column statistics are then reduced from the voxels. Returns
+    (counts_by_subplot, max_height, n_points) indexed like the groupby
+    results on the full cloud; an empty stream gives empty series.
+
+    >>> chunk = np.zeros(3, dtype=[('X', 'f8'), ('Y', 'f8'), ('Z', 'f8')])
+    >>> chunk['X'] = [0.5, 0.5, 1.5]
+    >>> chunk['Z'] = [0.1, 0.6, 0.2]
+    >>> counts, max_height, n_points = subplot_stats([chunk])
+    >>> max_height.tolist(), n_points.tolist()
+    ([0.6, 0.2], [2, 1])
+    >>> [len(result) for result in subplot_stats([chunk[:0]])]
+    [0, 0, 0]
+    """
+    voxels = VoxelAccumulator(('count', 'max'))
+    origin = None
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        indices = [
+            cell_index(chunk['X'], dxy),
+            cell_index(chunk['Y'], dxy),
+            cell_index(chunk['Z'], dz)]
+        if origin is None:
+            # map coordinates overflow 3D keys; count from the first chunk
+            origin = [index.min() for index in indices]
+        keys = pack_keys(*[index - o for index, o in zip(indices, origin)])
+        voxels.add(keys, chunk['Z'])
+    if origin is None:
+        # no points: an empty voxel set
+        voxels.add(np.zeros(0, dtype=np.int64), np.zeros(0))
+        origin = [0, 0, 0]
+
+    ix, iy, iz = [index + o for index, o in zip(
+        unpack_keys(voxels.result['keys'], 3), origin)]
+    counts_by_subplot = pd.Series(
+        voxels.result['count'], name='Z',
+        index=pd.MultiIndex.from_arrays(
+            [ix*dxy, iy*dxy, iz*dz], names=['Xbin', 'Ybin', 'Zbin']))
+
+    column_keys = pack_keys(ix, iy)
+    heights = aggregate(column_keys, voxels.result['max'], ('max',))
+    totals = aggregate(column_keys, voxels.result['count'], ('sum',))
+    cx, cy = unpack_keys(heights['keys'], 2)
+    index = pd.MultiIndex.from_arrays([cx*dxy, cy*dxy], names=['Xbin', 'Ybin'])
+    max_height = pd.Series(heights['max'], index=index, name='Z')
+    n_points = pd.Series(totals['sum'], index=index, name='Z')
+    return counts_by_subplot, max_height, n_points
+
+
+if __name__ == "__main__":
+    # Load the file
+    filename = 'uhnb3mes_rotate_scale.las'
+    working_dir = '/Users/kellycaylor/Documents/dev/sfm/'
+
+    #  Here is where we "make" subplots
+
+    dxy = 1.  # 2 meter bins in X and Y directions
+    dz = 0.25  # 0.5 meter bins in vertical.
+
+    # Coordinates are scaled by the LAS header.
+    counts_by_subplot, max_height, n_points = subplot_stats(
+        read_chunks(working_dir + filename), dxy, dz)
+
+    # Make profiles for each subplot
+    profiles, origin = create_profile(
+        read_chunks(working_dir + filename), dxy, dz)
+    profile_summary = profile_stats(profiles)
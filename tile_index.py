@@ -0,0 +1,200 @@
+# Persistent XY tile index for repeated polygon crops of a large cloud
+import json
+import os
+
+import numpy as np
+
+from crop import parse_polygon, points_in_polygon
+from pointcloud_io import CACHE_HEADER, PointCache, read_chunks
+from voxel import VoxelAccumulator, cell_index, pack_keys, unpack_keys
+
+
+TILES_FILE = 'tiles.npz'
+
+
+def build_index(source, index_dir, tile_size=10.0, chunk_size=1000000,
+                **kwargs):
+    """ Write a copy of a cloud sorted into tile_size x tile_size XY tiles.
+
+    source is anything pointcloud_io.read_chunks reads (LAS, xyz/csv or a
+    cache directory) and is streamed twice: once to count the points per
+    tile and once to scatter every chunk into its tiles' slots. index_dir
+    gets the columnar layout of pointcloud_io.write_cache, so it can also
+    be opened with PointCache or read_chunks, plus a tiles.npz with the
+    tile indices and point offsets. Returns the TileIndex.
+    """
+    def tile_keys(chunk):
+        return pack_keys(cell_index(chunk['X'], tile_size),
+                         cell_index(chunk['Y'], tile_size))
+
+    tiles = VoxelAccumulator(('count',))
+    header = {'count': 0, 'fields': {}, 'bounds': {}, 'tile_size': tile_size}
+    for chunk in read_chunks(source, chunk_size, **kwargs):
+        if not header['fields']:
+            for name in chunk.dtype.names:
+                dtype = np.dtype(chunk.dtype[name]).newbyteorder('<')
+                header['fields'][name] = {
+                    'dtype': dtype.str, 'scale': None, 'offset': None}
+        if len(chunk) == 0:
+            continue
+        for name in chunk.dtype.names:
+            lo, hi = float(chunk[name].min()), float(chunk[name].max())
+            bounds = header['bounds'].setdefault(name, [lo, hi])
+            bounds[0] = min(bounds[0], lo)
+            bounds[1] = max(bounds[1], hi)
+        tiles.add(tile_keys(chunk), chunk['Z'])
+        header['count'] += len(chunk)
+
+    os.makedirs(index_dir, exist_ok=True)
+    keys = tiles.result['keys']
+    counts = tiles.result['count']
+    stops = np.cumsum(counts)
+    starts = stops - counts
+    ix, iy = unpack_keys(keys, 2)
+    np.savez(os.path.join(index_dir, TILES_FILE),
+             ix=ix, iy=iy, start=starts, stop=stops)
+
+    columns = {
+        name: np.memmap(
+            os.path.join(index_dir, name + '.bin'), dtype=field['dtype'],
+            mode='w+', shape=(max(header['count'], 1),))
+        for name, field in header['fields'].items()}
+    fill = starts.copy()
+    for chunk in read_chunks(source, chunk_size, **kwargs):
+        if len(chunk) == 0:
+            continue
+        tile = np.searchsorted(keys, tile_keys(chunk))
+        order = np.argsort(tile, kind='stable')
+        tile = tile[order]
+        # position of each point within its tile's run in this chunk
+        first = np.flatnonzero(
+            np.concatenate(([True], tile[1:] != tile[:-1])))
+        run_start = np.repeat(first, np.diff(np.append(first, len(tile))))
+        positions = fill[tile] + np.arange(len(tile)) - run_start
+        for name, column in columns.items():
+            column[positions] = chunk[name][order]
+        fill += np.bincount(tile, minlength=len(keys))
+    for column in columns.values():
+        column.flush()
+    del columns
+
+    with open(os.path.join(index_dir, CACHE_HEADER), 'w') as f:
+        json.dump(header, f, indent=2)
+    return TileIndex(index_dir)
+
+
+def is_tile_index(path):
+    return os.path.exists(os.path.join(path, TILES_FILE))
+
+
+class TileIndex(PointCache):
+    """ A tile-sorted cache written by build_index.
+
+    crop() reads only the tiles that intersect the polygon's bounding box
+    and tests exact containment only in tiles that the polygon boundary
+    crosses, so repeated crops cost in proportion to the cropped area
+    rather than the whole cloud. Points on the polygon boundary are
+    inside (crop.points_in_polygon), so the point at (2.5, 0.5) on the
+    hypotenuse below is kept.
+
+    >>> import tempfile
+    >>> from pointcloud_io import write_cache
+    >>> chunk = np.zeros(5, dtype=[('X', 'f8'), ('Y', 'f8'), ('Z', 'f8')])
+    >>> chunk['X'] = [0.5, 2.5, 2.5, 25.0, 9.5]
+    >>> chunk['Y'] = [0.5, 0.5, 2.5, 25.0, 9.5]
+    >>> chunk['Z'] = [1.0, 2.0, 3.0, 4.0, 5.0]
+    >>> cache_dir = tempfile.mkdtemp()
+    >>> _ = write_cache([chunk], cache_dir)
+    >>> index = build_index(cache_dir, tempfile.mkdtemp(), tile_size=2.0)
+    >>> len(index), len(index.tiles['start'])
+    (5, 5)
+    >>> sorted(np.concatenate([c['Z'] for c in index.crop([[0, 0], [3, 0], [0, 3]])]).tolist())  # NOQA
+    [1.0, 2.0]
+    """
+    def __init__(self, index_dir, mode='r'):
+        PointCache.__init__(self, index_dir, mode)
+        self.tile_size = self.header['tile_size']
+        with np.load(os.path.join(index_dir, TILES_FILE)) as tiles:
+            self.tiles = {name: tiles[name] for name in tiles.files}
+
+    def query(self, polygon):
+        """ Tiles intersecting a polygon, split into those lying entirely
+        inside it and those crossed by its boundary.
+
+        Returns (inside, boundary) arrays of positions in self.tiles.
+        """
+        polygon = parse_polygon(polygon)
+        lo = polygon.min(axis=0)
+        hi = polygon.max(axis=0)
+        d = self.tile_size
+        ix, iy = self.tiles['ix'], self.tiles['iy']
+        candidates = np.flatnonzero(
+            (ix >= np.floor(lo[0]/d)) & (ix <= np.floor(hi[0]/d)) &
+            (iy >= np.floor(lo[1]/d)) & (iy <= np.floor(hi[1]/d)))
+        box_lo = np.column_stack((ix[candidates], iy[candidates]))*d
+        box_hi = box_lo + d
+        # a tile is inside if its corners are and no edge crosses it
+        inside = np.ones(len(candidates), dtype=bool)
+        for corner in ((0, 0), (0, 1), (1, 0), (1, 1)):
+            xy = np.where(corner, box_hi, box_lo)
+            inside &= points_in_polygon(xy[:, 0], xy[:, 1], polygon)
+        for p0, p1 in zip(polygon, np.roll(polygon, -1, axis=0)):
+            inside &= ~_segment_hits_boxes(p0, p1, box_lo, box_hi)
+        return candidates[inside], candidates[~inside]
+
+    def crop(self, polygon, fields=None):
+        """ Yield one structured array per tile of the points inside
+        polygon (corner points, or a WKT POLYGON string) """
+        fields = fields or self.fields
+        dtype = [(name, self.header['fields'][name]['dtype'])
+                 for name in fields]
+        inside, boundary = self.query(polygon)
+        on_boundary = np.zeros(len(self.tiles['start']), dtype=bool)
+        on_boundary[boundary] = True
+        polygon = parse_polygon(polygon)
+        for tile in np.sort(np.concatenate((inside, boundary))):
+            start, stop = self.tiles['start'][tile], self.tiles['stop'][tile]
+            keep = slice(None)
+            if on_boundary[tile]:
+                keep = points_in_polygon(
+                    self.raw('X')[start:stop], self.raw('Y')[start:stop],
+                    polygon)
+            columns = {name: self.raw(name)[start:stop][keep]
+                       for name in fields}
+            chunk = np.empty(len(columns[fields[0]]), dtype=dtype)
+            for name in fields:
+                chunk[name] = columns[name]
+            yield chunk
+
+
+def _segment_hits_boxes(p0, p1, lo, hi):
+    # Liang-Barsky clip of the segment p0-p1 against each box lo-hi
+    t0 = np.zeros(len(lo))
+    t1 = np.ones(len(lo))
+    hit = np.ones(len(lo), dtype=bool)
+    for axis in range(2):
+        d = p1[axis] - p0[axis]
+        if d == 0:
+            hit &= (lo[:, axis] <= p0[axis]) & (p0[axis] <= hi[:, axis])
+            continue
+        ta = (lo[:, axis] - p0[axis])/d
+        tb = (hi[:, axis] - p0[axis])/d
+        t0 = np.maximum(t0, np.minimum(ta, tb))
+        t1 = np.minimum(t1, np.maximum(ta, tb))
+    return hit & (t0 <= t1)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Build a tile index of a point cloud for fast polygon '
+                    'crops.')
+    parser.add_argument('source', help='LAS, xyz/csv or cache directory')
+    parser.add_argument('index_dir')
+    parser.add_argument('--tile-size', type=float, default=10.0)
+    parser.add_argument('--chunk-size', type=int, default=1000000)
+    args = parser.parse_args()
+    index = build_index(args.source, args.index_dir, args.tile_size,
+                        args.chunk_size)
+    print('Indexed {} points in {} tiles in {}.'.format(
+        len(index), len(index.tiles['start']), args.index_dir))
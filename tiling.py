@@ -0,0 +1,249 @@
+########################################################################
+#
+# tiling.py - tiled, halo-overlapped random_field generation
+#
+# split a Grid domain into tiles with overlapping halos, generate each
+# tile independently (in a process pool, or one tile per machine given
+# its index), and blend the halos into a single on-disk .npy array
+#
+########################################################################
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from random_field import Params, Grid, FIELD_ENGINES
+
+
+class TileLayout():
+    """ Tiles the cell index space of a Grid, with halos of `halo` cells
+    added on every side that has a neighbouring tile.
+
+    >>> layout = TileLayout(Grid(), (40, 40, 1), 5)
+    >>> len(layout)
+    9
+    >>> [lo.tolist() + hi.tolist() for lo, hi in [layout.extent(4)]]
+    [[35, 35, 0, 85, 85, 1]]
+    >>> [lo.tolist() + hi.tolist() for lo, hi in [layout.extent(8)]]
+    [[75, 75, 0, 100, 100, 1]]
+    """
+    def __init__(self, grid, tile_shape, halo):
+        self.grid = grid
+        self.N = np.array(grid.N, int)
+        self.tile_shape = np.minimum(np.array(tile_shape, int), self.N)
+        self.halo = np.broadcast_to(np.array(halo, int), (3,))
+        self.counts = -(-self.N // self.tile_shape)
+
+    def __len__(self):
+        return int(self.counts.prod())
+
+    def core(self, index):
+        """ Index box (lo, hi) of the cells a tile is responsible for """
+        position = np.array(np.unravel_index(index, self.counts))
+        lo = position*self.tile_shape
+        hi = np.minimum(lo + self.tile_shape, self.N)
+        return lo, hi
+
+    def extent(self, index):
+        """ Index box (lo, hi) of a tile including its halo """
+        lo, hi = self.core(index)
+        return (np.maximum(lo - self.halo, 0),
+                np.minimum(hi + self.halo, self.N))
+
+    def weights(self, index):
+        """ Blending weights over a tile's extent, flattened like values.
+
+        Weights ramp linearly across the 2*halo cells shared with each
+        neighbouring tile, so overlapping tiles cross-fade into each
+        other instead of meeting at a seam (see stitch for how the
+        variance is kept across the fade).
+        """
+        lo, hi = self.core(index)
+        e_lo, e_hi = self.extent(index)
+        ramps = []
+        for axis in range(3):
+            w = np.ones(e_hi[axis] - e_lo[axis])
+            h = self.halo[axis]
+            if h > 0:
+                x = np.arange(e_lo[axis], e_hi[axis]) + 0.5
+                if lo[axis] > 0:
+                    w = np.minimum(w, (x - e_lo[axis])/(2.0*h))
+                if hi[axis] < self.N[axis]:
+                    w = np.minimum(w, (e_hi[axis] - x)/(2.0*h))
+            ramps.append(w)
+        return np.einsum('i,j,k->ijk', *ramps).ravel()
+
+
+def tile_path(tile_dir, index):
+    return os.path.join(tile_dir, 'tile_{:06d}.npy'.format(index))
+
+
+def generate_tile(index, tile_shape, halo, tile_dir, base_seed=0,
+                  engine='spectral', params=None, domain_file='domain.txt',
+                  force=False):
+    """ Generate one tile (halo included) and write it to tile_dir.
+
+    The tile's RNG stream depends only on base_seed and the tile index,
+    so a failed tile can be regenerated alone, on any machine. Existing
+    tiles are skipped unless force is set; tiles are written to a
+    temporary file and renamed, so a crash never leaves a partial tile.
+    """
+    path = tile_path(tile_dir, index)
+    if os.path.exists(path) and not force:
+        return path
+    grid = Grid(domain_file)
+    layout = TileLayout(grid, tile_shape, halo)
+    lo, hi = layout.extent(index)
+    sub = grid.SubGrid(lo, hi)
+    if params is None:
+        params = Params()
+    rng = np.random.default_rng(
+        np.random.SeedSequence(base_seed, spawn_key=(index,)))
+    FIELD_ENGINES[engine](
+        params, sub, rng=rng,
+        domain_fraction=sub.N.prod()/float(grid.N.prod()))
+    os.makedirs(tile_dir, exist_ok=True)
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, sub.values.reshape(sub.N))
+    os.replace(tmp_path, path)
+    return path
+
+
+def missing_tiles(layout, tile_dir):
+    return [i for i in range(len(layout))
+            if not os.path.exists(tile_path(tile_dir, i))]
+
+
+def stitch(tile_shape, halo, tile_dir, output_file='field.npy',
+           domain_file='domain.txt', params=None):
+    """ Blend all tiles into a .npy array of shape Grid.N on disk.
+
+    Tiles are independent realizations, so a plain weighted average
+    would shrink the variance in the blend band (to half at its centre)
+    and leave a smooth seam. Instead the deviations of each tile from
+    the mean of all tiles are summed with weights w and divided by
+    sqrt(sum w**2), which keeps the variance of stationary tiles (such
+    as SpectralField's) everywhere. The result is clipped to the
+    [min_value, max_value] range of params, as the engines clip theirs.
+
+    Tiles are read one at a time and accumulated into memory-mapped
+    arrays, so the full field never needs to fit in memory.
+
+    >>> import tempfile
+    >>> layout, bands, cores = TileLayout(Grid(), (40, 40, 1), 5), [], []
+    >>> for seed in range(8):
+    ...     tile_dir = tempfile.mkdtemp()
+    ...     for index in range(len(layout)):
+    ...         _ = generate_tile(index, (40, 40, 1), 5, tile_dir, seed)
+    ...     field = stitch((40, 40, 1), 5, tile_dir,
+    ...                    os.path.join(tile_dir, 'field.npy'))[:, :, 0]
+    ...     bands.append(field[35:45])
+    ...     cores.append(field[10:30])
+    >>> ratio = np.std(bands)/np.std(cores)
+    >>> bool(0.95 < ratio < 1.05)
+    True
+    >>> bool(field.min() >= -3.0 and field.max() <= 1.5)
+    True
+    """
+    if params is None:
+        params = Params()
+    grid = Grid(domain_file)
+    layout = TileLayout(grid, tile_shape, halo)
+    missing = missing_tiles(layout, tile_dir)
+    if missing:
+        raise FileNotFoundError(
+            'missing tiles: ' + ', '.join(str(i) for i in missing))
+    shape = tuple(int(n) for n in layout.N)
+    out = np.lib.format.open_memmap(
+        output_file, mode='w+', dtype=float, shape=shape)
+    sums = {}
+    for name in ('w', 'w2'):
+        sums[name] = np.lib.format.open_memmap(
+            os.path.join(tile_dir, '{}.tmp.npy'.format(name)), mode='w+',
+            dtype=float, shape=shape)
+    # out collects sum(w*v); the mean of all tiles is subtracted at the
+    # end as mean*sum(w), so every tile is read only once
+    total = count = 0.0
+    for index in range(len(layout)):
+        lo, hi = layout.extent(index)
+        box = tuple(slice(a, b) for a, b in zip(lo, hi))
+        w = layout.weights(index).reshape(hi - lo)
+        values = np.load(tile_path(tile_dir, index))
+        total += values.sum(dtype=float)
+        count += values.size
+        out[box] += values*w
+        sums['w'][box] += w
+        sums['w2'][box] += w*w
+    mean = total/count
+    for i in range(shape[0]):
+        out[i] -= mean*sums['w'][i]
+        out[i] /= np.sqrt(sums['w2'][i])
+        out[i] += mean
+        np.clip(out[i], params.min_value, params.max_value, out=out[i])
+    out.flush()
+    for name in list(sums):
+        filename = sums.pop(name).filename
+        os.remove(filename)
+    return out
+
+
+def run(tile_shape, halo, tile_dir, output_file='field.npy', base_seed=0,
+        engine='spectral', params=None, domain_file='domain.txt',
+        workers=None, force=False):
+    """ Generate every missing tile in a process pool, then stitch """
+    layout = TileLayout(Grid(domain_file), tile_shape, halo)
+    todo = range(len(layout)) if force else missing_tiles(layout, tile_dir)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                generate_tile, index, tile_shape, halo, tile_dir, base_seed,
+                engine, params, domain_file, force)
+            for index in todo]
+        for future in futures:
+            print('\t... wrote {}'.format(future.result()))
+    return stitch(tile_shape, halo, tile_dir, output_file, domain_file,
+                  params)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Tiled random_field generation with blended halos.')
+    parser.add_argument('command', choices=['run', 'tile', 'stitch'])
+    parser.add_argument('--index', type=int, default=None,
+                        help='tile index to generate (command: tile)')
+    parser.add_argument('--tile-shape', type=int, nargs=3,
+                        default=[256, 256, 64])
+    parser.add_argument('--halo', type=int, default=16)
+    parser.add_argument('--tile-dir', default='tiles')
+    parser.add_argument('-o', '--output', default='field.npy')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=sorted(FIELD_ENGINES),
+                        default='spectral')
+    parser.add_argument('--domain', default='domain.txt')
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true',
+                        help='regenerate tiles that already exist')
+    args = parser.parse_args(argv)
+
+    if args.command == 'tile':
+        if args.index is None:
+            parser.error('tile requires --index')
+        print(generate_tile(
+            args.index, args.tile_shape, args.halo, args.tile_dir,
+            args.seed, args.engine, domain_file=args.domain,
+            force=args.force))
+    elif args.command == 'stitch':
+        stitch(args.tile_shape, args.halo, args.tile_dir, args.output,
+               args.domain)
+        print('Wrote stitched field to {}.'.format(args.output))
+    else:
+        run(args.tile_shape, args.halo, args.tile_dir, args.output,
+            args.seed, args.engine, domain_file=args.domain,
+            workers=args.workers, force=args.force)
+        print('Wrote stitched field to {}.'.format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+# Sort/reduceat aggregation of point values by 2D column or 3D voxel
+import numpy as np
+
+
+# reducers that can be merged across chunks
+REDUCERS = ('count', 'sum', 'min', 'max', 'mean')
+
+
+def cell_index(coords, d, origin=0.0):
+    """ Integer cell index of coordinates for cells of size d
+
+    >>> cell_index(np.array([0.0, 0.99, 1.0, -0.5]), 1.0).tolist()
+    [0, 0, 1, -1]
+    """
+    return np.floor((np.asarray(coords) - origin)/d).astype(np.int64)
+
+
+def pack_keys(*indices):
+    """ Pack 2 or 3 integer cell index arrays into one int64 key per point.
+
+    Each index gets 63 // ndim bits around a fixed offset, so keys from
+    different chunks (or files) with the same cell indices always agree
+    and sort in (x, y[, z]) order. Indices must lie in
+    [-2**(bits - 1), 2**(bits - 1)), i.e. about +-1e6 cells in 3D, so
+    subtract a common origin from map coordinates first.
+
+    >>> keys = pack_keys(np.array([0, -3]), np.array([5, 7]), np.array([1, 2]))
+    >>> [k.tolist() for k in unpack_keys(keys, 3)]
+    [[0, -3], [5, 7], [1, 2]]
+    >>> pack_keys(np.array([1051944]), np.array([0]), np.array([0]))
+    Traceback (most recent call last):
+    ...
+    ValueError: cell indices out of range for 3D keys: [1051944, 1051944]
+    """
+    bits = 63//len(indices)
+    offset = 1 << (bits - 1)
+    keys = np.zeros(len(indices[0]), dtype=np.int64)
+    for index in indices:
+        index = np.asarray(index, dtype=np.int64)
+        if len(index) and (index.min() < -offset or index.max() >= offset):
+            raise ValueError(
+                'cell indices out of range for {}D keys: [{}, {}]'.format(
+                    len(indices), index.min(), index.max()))
+        keys <<= bits
+        keys |= index + offset
+    return keys
+
+
+def unpack_keys(keys, ndim):
+    """ Inverse of pack_keys; returns a list of ndim index arrays """
+    bits = 63//ndim
+    offset = 1 << (bits - 1)
+    mask = (1 << bits) - 1
+    indices = []
+    for shift in range(ndim - 1, -1, -1):
+        indices.append(((keys >> (shift*bits)) & mask) - offset)
+    return indices
+
+
+def _group_starts(sorted_keys):
+    # start offset of each run of equal keys in a sorted key array
+    if len(sorted_keys) == 0:
+        return np.zeros(0, dtype=np.intp)
+    return np.flatnonzero(
+        np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+
+
+def aggregate(keys, values, reducers=('count', 'max'), percentiles=()):
+    """ Reduce values per cell key with a single sort.
+
+    Returns a dict with the sorted unique 'keys' and one array per
+    reducer (see REDUCERS) and per percentile q (as 'p<q>'). Percentiles
+    are exact but, unlike the other reducers, cannot be merged across
+    chunks.
+
+    >>> keys = np.array([3, 1, 3, 1, 2])
+    >>> values = np.array([1.0, 4.0, 5.0, 2.0, 0.5])
+    >>> result = aggregate(keys, values, REDUCERS, percentiles=[50])
+    >>> [result[name].tolist() for name in ('keys', 'count', 'sum', 'max', 'mean', 'p50')]  # NOQA
+    [[1, 2, 3], [2, 1, 2], [6.0, 0.5, 6.0], [4.0, 0.5, 5.0], [3.0, 0.5, 3.0], [3.0, 0.5, 3.0]]
+    """
+    keys = np.asarray(keys)
+    values = np.asarray(values)
+    if len(percentiles):
+        # sort by value within key, so each run is ready for percentiles
+        order = np.lexsort((values, keys))
+    else:
+        order = np.argsort(keys)
+    sorted_keys = keys[order]
+    sorted_values = values[order]
+    starts = _group_starts(sorted_keys)
+    counts = np.diff(np.append(starts, len(keys)))
+
+    result = {'keys': sorted_keys[starts]}
+    if len(keys) == 0:
+        for name in reducers:
+            result[name] = counts if name == 'count' else np.zeros(0)
+        for q in percentiles:
+            result['p{}'.format(q)] = np.zeros(0, dtype=float)
+        return result
+    for name in reducers:
+        if name == 'count':
+            result[name] = counts
+        elif name == 'sum':
+            result[name] = np.add.reduceat(sorted_values, starts)
+        elif name == 'min':
+            result[name] = np.minimum.reduceat(sorted_values, starts)
+        elif name == 'max':
+            result[name] = np.maximum.reduceat(sorted_values, starts)
+        elif name == 'mean':
+            result[name] = np.add.reduceat(sorted_values, starts)/counts
+        else:
+            raise ValueError('unknown reducer: {}'.format(name))
+    for q in percentiles:
+        # linear interpolation between order statistics, as np.percentile
+        position = starts + (counts - 1)*(q/100.0)
+        lower = np.floor(position).astype(np.intp)
+        upper = np.minimum(lower + 1, starts + counts - 1)
+        fraction = position - lower
+        result['p{}'.format(q)] = (
+            sorted_values[lower]*(1 - fraction) +
+            sorted_values[upper]*fraction)
+    return result
+
+
+def merge(a, b):
+    """ Merge two partial aggregate() results over the same reducers.
+
+    >>> a = aggregate(np.array([1, 2]), np.array([1.0, 2.0]), REDUCERS)
+    >>> b = aggregate(np.array([2, 3]), np.array([4.0, 3.0]), REDUCERS)
+    >>> m = merge(a, b)
+    >>> [m[name].tolist() for name in ('keys', 'count', 'min', 'max', 'mean')]
+    [[1, 2, 3], [1, 2, 1], [1.0, 2.0, 3.0], [1.0, 4.0, 3.0], [1.0, 3.0, 3.0]]
+    """
+    reducers = [name for name in a if name != 'keys']
+    for name in reducers:
+        if name not in REDUCERS:
+            raise ValueError('cannot merge reducer: {}'.format(name))
+    keys = np.concatenate((a['keys'], b['keys']))
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    starts = _group_starts(sorted_keys)
+    result = {'keys': sorted_keys[starts]}
+    if len(keys) == 0:
+        result.update({name: a[name] for name in reducers})
+        return result
+
+    def combine(name, ufunc):
+        stacked = np.concatenate((a[name], b[name]))[order]
+        return ufunc.reduceat(stacked, starts)
+
+    count = combine('count', np.add) if 'count' in a else None
+    for name in reducers:
+        if name in ('count', 'sum'):
+            result[name] = combine(name, np.add)
+        elif name == 'min':
+            result[name] = combine(name, np.minimum)
+        elif name == 'max':
+            result[name] = combine(name, np.maximum)
+    if 'mean' in a:
+        # recover the sums from the means to re-weight them by count
+        if count is None:
+            raise ValueError('merging means requires the count reducer')
+        sums = np.concatenate((
+            a['mean']*a['count'], b['mean']*b['count']))[order]
+        result['mean'] = np.add.reduceat(sums, starts)/count
+    return result
+
+
+class VoxelAccumulator():
+    """ Accumulates aggregate() results over a stream of chunks.
+
+    Partial results are kept as a stack of runs and merged pairwise, like
+    a binary counter, whenever the newest run is at least as large as the
+    one below it, so every voxel is re-sorted O(log chunks) times rather
+    than once per chunk; result merges what is left.
+
+    >>> acc = VoxelAccumulator(('count', 'max'))
+    >>> acc.add(np.array([5, 1]), np.array([1.0, 2.0]))
+    >>> acc.add(np.array([5]), np.array([3.0]))
+    >>> [acc.result[name].tolist() for name in ('keys', 'count', 'max')]
+    [[1, 5], [1, 2], [2.0, 3.0]]
+    """
+    def __init__(self, reducers=('count', 'max')):
+        self.reducers = tuple(reducers)
+        if 'mean' in self.reducers and 'count' not in self.reducers:
+            self.reducers += ('count',)
+        self._runs = []
+
+    def add(self, keys, values):
+        partial = aggregate(keys, values, self.reducers)
+        while self._runs and (
+                len(self._runs[-1]['keys']) <= len(partial['keys'])):
+            partial = merge(self._runs.pop(), partial)
+        self._runs.append(partial)
+
+    @property
+    def result(self):
+        if not self._runs:
+            return None
+        while len(self._runs) > 1:
+            partial = self._runs.pop()
+            self._runs.append(merge(self._runs.pop(), partial))
+        return self._runs[0]
+
+
+class ProfileCube():
+    """ Dense (Xbin, Ybin, Zbin) point-count cube built one chunk at a time.
+
+    Each chunk is counted with a single bincount over the flattened voxel
+    indices of its own bounding box and added into the cube, which grows
+    to cover new chunks. counts[i, j, k] is the number of points in the
+    voxel with cell indices origin + (i, j, k).
+
+    >>> cube = ProfileCube(dxy=1.0, dz=0.5)
+    >>> cube.add(np.array([0.5, 0.5, 1.5]), np.array([0.2, 0.2, 0.2]), np.array([0.1, 0.7, 0.1]))  # NOQA
+    >>> cube.add(np.array([2.5]), np.array([0.2]), np.array([1.2]))
+    >>> cube.origin.tolist(), cube.counts.shape
+    ([0, 0, 0], (3, 1, 3))
+    >>> cube.counts[:, 0, :].tolist()
+    [[1, 1, 0], [1, 0, 0], [0, 0, 1]]
+    """
+    def __init__(self, dxy=1., dz=0.25, dtype=np.uint32):
+        self.dxy = dxy
+        self.dz = dz
+        self.dtype = dtype
+        self.counts = None
+        self.origin = None
+
+    def add(self, x, y, z):
+        if len(x) == 0:
+            return
+        indices = [
+            cell_index(x, self.dxy),
+            cell_index(y, self.dxy),
+            cell_index(z, self.dz)]
+        lo = np.array([i.min() for i in indices])
+        hi = np.array([i.max() + 1 for i in indices])
+        self._grow(lo, hi)
+        shape = tuple(hi - lo)
+        flat = np.ravel_multi_index(
+            [i - l for i, l in zip(indices, lo)], shape)
+        local = np.bincount(flat, minlength=int(np.prod(shape)))
+        box = tuple(
+            slice(a, b) for a, b in zip(lo - self.origin, hi - self.origin))
+        self.counts[box] += local.reshape(shape).astype(self.dtype)
+
+    def _grow(self, lo, hi):
+        # reallocate the cube so that it covers cell indices lo:hi
+        if self.counts is None:
+            self.origin = lo
+            self.counts = np.zeros(tuple(hi - lo), dtype=self.dtype)
+            return
+        end = self.origin + self.counts.shape
+        new_lo = np.minimum(lo, self.origin)
+        new_hi = np.maximum(hi, end)
+        if np.array_equal(new_lo, self.origin) and np.array_equal(new_hi, end):  # NOQA
+            return
+        counts = np.zeros(tuple(new_hi - new_lo), dtype=self.dtype)
+        box = tuple(slice(a, b) for a, b in zip(
+            self.origin - new_lo, end - new_lo))
+        counts[box] = self.counts
+        self.counts = counts
+        self.origin = new_lo
+
+
+def profile_cube(chunks, dxy=1., dz=0.25):
+    """ Dense count cube and its origin cell index from a chunk iterator """
+    cube = ProfileCube(dxy, dz)
+    for chunk in chunks:
+        cube.add(chunk['X'], chunk['Y'], chunk['Z'])
+    return cube.counts, cube.origin
+
+
+def sparse_profile(chunks, dxy=1., dz=0.25):
+    """ COO form of the count cube for sparse canopies: returns the
+    (ix, iy, iz) cell indices of the occupied voxels and their counts
+    (empty arrays for a stream without points)
+
+    >>> chunk = np.zeros(3, dtype=[('X', 'f8'), ('Y', 'f8'), ('Z', 'f8')])
+    >>> chunk['X'] = [0.5, 0.5, 1.5]
+    >>> [a.tolist() for a in sparse_profile([chunk, chunk[:0]], dz=0.5)]
+    [[0, 1], [0, 0], [0, 0], [2, 1]]
+    >>> [len(a) for a in sparse_profile([chunk[:0]])]
+    [0, 0, 0, 0]
+    """
+    voxels = VoxelAccumulator(('count',))
+    origin = None
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        indices = [
+            cell_index(chunk['X'], dxy),
+            cell_index(chunk['Y'], dxy),
+            cell_index(chunk['Z'], dz)]
+        if origin is None:
+            # map coordinates overflow 3D keys; count from the first chunk
+            origin = [index.min() for index in indices]
+        voxels.add(pack_keys(
+            *[index - o for index, o in zip(indices, origin)]), chunk['Z'])
+    if origin is None:
+        # no points: an empty voxel set
+        voxels.add(np.zeros(0, dtype=np.int64), np.zeros(0))
+        origin = [0, 0, 0]
+    ix, iy, iz = [index + o for index, o in zip(
+        unpack_keys(voxels.result['keys'], 3), origin)]
+    return ix, iy, iz, voxels.result['count']
+
+
+def profile_stats(counts):
+    """ Per-column statistics of a count cube (vertical bins on the last
+    axis): point totals, the proportion and cumulative fraction of points
+    per vertical bin, and foliage height diversity (-sum p ln p).
+    Columns without points get nan proportions and fhd.
+
+    >>> stats = profile_stats(np.array([[[2, 0, 2], [0, 0, 0]]]))
+    >>> stats['total'].tolist(), stats['cumulative_fraction'][0, 0].tolist()
+    ([[4, 0]], [0.5, 0.5, 1.0])
+    >>> round(float(stats['fhd'][0, 0]), 4), bool(np.isnan(stats['fhd'][0, 1]))
+    (0.6931, True)
+    """
+    total = counts.sum(axis=-1, dtype=np.int64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        proportion = counts/total[..., np.newaxis]
+        cumulative_fraction = np.cumsum(counts, axis=-1)/total[..., np.newaxis]
+        plogp = np.where(proportion > 0, proportion*np.log(proportion), 0.0)
+    fhd = np.where(total > 0, -plogp.sum(axis=-1), np.nan)
+    return {
+        'total': total,
+        'proportion': proportion,
+        'cumulative_fraction': cumulative_fraction,
+        'fhd': fhd,
+    }
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()